@@ -0,0 +1,98 @@
+"""
+Benchmarks the throughput of the JSON codecs available in mapreduce.py.
+
+Every codec is measured on a filter pass (decode -> keep instance -> encode)
+and on a map pass (decode -> modify instance -> encode), once with the 
+stdlib json backend and once with orjson (if installed).
+The json codec corresponds to the path used by all scripts by default.
+
+If no input directory is given, synthetic dataset entries are generated.
+"""
+import os
+import argparse
+import random
+import time
+import json
+
+from glob import glob
+from itertools import islice
+
+from mapreduce import JsonCodec, SLCCodec, iter_jsonl_gz, orjson
+
+
+def synthetic_lines(num_records, seed = 0):
+    random.seed(seed)
+
+    for i in range(num_records):
+        entry = {
+            "project": "project-%d" % random.randint(0, 1000),
+            "commit_sha": "%040x" % random.getrandbits(160),
+            "parent_sha": "%040x" % random.getrandbits(160),
+            "file_path": "src/module_%d.py" % i,
+            "project_url": "https://github.com/user/project-%d" % random.randint(0, 1000),
+            "likely_bug": random.random() < 0.3,
+            "comodified": random.random() < 0.5,
+            "in_function": random.random() < 0.8,
+            "sstub_pattern": random.choice(["SINGLE_STMT", "CHANGE_IDENTIFIER_USED", "CHANGE_BINARY_OPERAND"]),
+            "diff": "@@ -10,7 +10,7 @@ def main():\n     x = 1\n     y = 2\n-    return x + y\n+    return x - y\n     \n",
+            "before": "return x + y",
+            "after": "return x - y",
+            "edit_script": json.dumps([["Update", ["binary_operator:+", 12, 13, 12, 14], "-"]]),
+        }
+        yield (json.dumps(entry) + "\n").encode("utf-8")
+
+
+def load_lines(input_dir, num_records):
+    jsonl_files = glob(os.path.join(input_dir, "*.jsonl.gz")) + glob(os.path.join(input_dir, "*.jsonl"))
+    entries = islice(iter_jsonl_gz(jsonl_files), num_records)
+    return [(json.dumps(entry) + "\n").encode("utf-8") for entry in entries]
+
+
+def run_pass(codec, lines, modify = False):
+    start_time = time.perf_counter()
+
+    for line in lines:
+        instance = codec.decode(line)
+        if modify: instance["sstub_pattern"] = "SINGLE_STMT"
+        codec.encode(instance)
+
+    return len(lines) / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir")
+    parser.add_argument("--num_records", type=int, default=100_000)
+    parser.add_argument("--repeats", type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.input_dir:
+        lines = load_lines(args.input_dir, args.num_records)
+    else:
+        lines = list(synthetic_lines(args.num_records))
+
+    print("Benchmark on %d instances (best of %d runs)" % (len(lines), args.repeats))
+    print("%-10s\t| %-15s\t| %-15s" % ("Codec", "Filter (inst/s)", "Map (inst/s)"))
+    print("-----------------------------------------------------")
+
+    codecs = [("json", JsonCodec("json")), ("slc[json]", SLCCodec("json"))]
+
+    if orjson is not None:
+        codecs += [("fast", JsonCodec("orjson")), ("slc[orjson]", SLCCodec("orjson"))]
+
+    baseline = None
+    for name, codec in codecs:
+
+        filter_speed = max(run_pass(codec, lines) for _ in range(args.repeats))
+        map_speed    = max(run_pass(codec, lines, modify = True) for _ in range(args.repeats))
+
+        if baseline is None: baseline = filter_speed, map_speed
+
+        print("%-10s\t| %-8d (%.1fx)\t| %-8d (%.1fx)" % (
+            name, filter_speed, filter_speed / baseline[0], map_speed, map_speed / baseline[1]
+        ))
+
+
+if __name__ == '__main__':
+    main()
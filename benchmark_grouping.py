@@ -0,0 +1,80 @@
+"""
+Benchmarks the memory bounded grouping in mapreduce.py.
+
+Generates a stream of synthetic dataset entries whose projects are spread 
+randomly over the stream, groups them by project url and reports runtime, 
+peak memory and whether every project was emitted as exactly one complete group.
+
+The dataset scale (28M entries) can be tested with --num_records 28000000.
+"""
+import argparse
+import random
+import resource
+import time
+
+from mapreduce import ExternalGrouper
+
+
+def synthetic_stream(num_records, num_projects, record_bytes, seed = 0):
+    rng = random.Random(seed)
+    padding = "x" * record_bytes
+
+    for i in range(num_records):
+        yield {
+            "project_url": "https://github.com/user/project-%d" % rng.randrange(num_projects),
+            "commit_sha": "%040x" % i,
+            "diff": padding,
+        }
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_records", type=int, default=1_000_000)
+    parser.add_argument("--num_projects", type=int, default=100_000)
+    parser.add_argument("--record_bytes", type=int, default=500)
+    parser.add_argument("--memory_mb", type=float, default=256)
+    parser.add_argument("--tmp_dir")
+
+    args = parser.parse_args()
+
+    grouper = ExternalGrouper(lambda slc: slc["project_url"], 
+                                memory_budget = args.memory_mb * 1e6, 
+                                tmp_dir = args.tmp_dir)
+
+    stream = synthetic_stream(args.num_records, args.num_projects, args.record_bytes)
+
+    start_time = time.time()
+    rss_before = peak_rss_mb()
+
+    seen_keys, num_records, num_groups = set(), 0, 0
+    exactly_once = True
+
+    for i, group in enumerate(grouper(stream)):
+        key = group[0]["project_url"]
+        
+        if key in seen_keys or any(slc["project_url"] != key for slc in group): 
+            exactly_once = False
+        
+        seen_keys.add(key)
+        num_records += len(group)
+        num_groups  += 1
+
+        if i % 10_000 == 0: print("Groups: %d | Peak RSS: %.0f MB" % (num_groups, peak_rss_mb()), end = "\r")
+
+    run_time = time.time() - start_time
+
+    print()
+    print("Records:         \t%d / %d" % (num_records, args.num_records))
+    print("Groups:          \t%d" % num_groups)
+    print("Exactly once:    \t%s" % (exactly_once and num_records == args.num_records))
+    print("Sorted runs:     \t%d" % grouper.num_runs)
+    print("Time:            \t%.1f s (%.0f records/s)" % (run_time, num_records / run_time))
+    print("Peak RSS:        \t%.0f MB (%.0f MB before grouping, budget %.0f MB)" % (peak_rss_mb(), rss_before, args.memory_mb))
+
+
+if __name__ == '__main__':
+    main()
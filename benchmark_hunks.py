@@ -0,0 +1,207 @@
+"""
+Benchmarks the hunk processing of run_slc_process.py.
+
+Compares HunkProcessor (every hunk is parsed once and every diff level and
+edit script is computed at most once) against the previous escalation loop
+that recomputed the edit script and the statement diff for every level.
+Reports the time for all hunks and for the hunks that needed a larger diff level,
+the number of edit scripts that were computed by each implementation
+and how many results of both implementations are the same.
+
+If no input directory is given, single token mutations of the Python standard library are generated.
+"""
+import os
+import re
+import argparse
+import random
+import sysconfig
+import time
+
+from glob import glob
+from itertools import islice
+from collections import Counter
+
+import code_diff as cd
+from code_diff.diff_utils import parse_hunks, clean_hunk
+from code_diff.gumtree    import json_serialize
+
+from mapreduce import iter_jsonl_gz
+from run_slc_process import HunkProcessor, EDIT_LEVELS, _is_ghost_script
+
+
+# Hunks ----------------------------------------------------------------
+
+MUTATIONS = [("==", "!="), ("<", "<="), (">", ">="), (" + ", " - "), (" and ", " or "), ("True", "False"), ("None", "0")]
+
+
+def _mutate_line(line, identifiers, rng):
+    choice = rng.random()
+
+    if choice < 0.4:
+        mutations = [(a, b) for a, b in MUTATIONS if a in line]
+        if mutations:
+            a, b = rng.choice(mutations)
+            return line.replace(a, b, 1)
+    elif choice < 0.7:
+        numbers = list(re.finditer(r"\b\d+\b", line))
+        if numbers:
+            match = rng.choice(numbers)
+            return line[:match.start()] + str(int(match.group()) + 1) + line[match.end():]
+    else:
+        names = list(re.finditer(r"\b[a-z_][a-z0-9_]{2,}\b", line))
+        if names:
+            match = rng.choice(names)
+            return line[:match.start()] + rng.choice(identifiers) + line[match.end():]
+
+    return None
+
+
+def synthetic_diffs(num_hunks, seed = 0):
+    rng = random.Random(seed)
+    stdlib = sysconfig.get_paths()["stdlib"]
+
+    files = sorted(os.path.join(root, name) for root, _, names in os.walk(stdlib)
+                    if "site-packages" not in root and "test" not in root
+                    for name in names if name.endswith(".py"))
+    rng.shuffle(files)
+
+    num_diffs = 0
+    for path in files:
+        if num_diffs >= num_hunks: break
+
+        try:
+            with open(path, "r", encoding = "utf-8") as i:
+                lines = i.read().splitlines(True)
+        except (OSError, UnicodeDecodeError):
+            continue
+
+        if not lines: continue
+        identifiers = sorted(set(re.findall(r"\b[a-z_][a-z0-9_]{2,}\b", "".join(lines))))
+
+        for _ in range(5):
+            index = rng.randrange(len(lines))
+            line  = lines[index]
+            stripped = line.strip()
+            if not stripped or stripped.startswith(("#", "'", '"')) or len(stripped) > 100: continue
+
+            mutated = _mutate_line(line, identifiers, rng)
+            if mutated is None or mutated == line: continue
+
+            start, end = max(0, index - 3), min(len(lines), index + 4)
+            body = [" " + l for l in lines[start:index]] + ["-" + line, "+" + mutated] + [" " + l for l in lines[index + 1:end]]
+            body = [l if l.endswith("\n") else l + "\n" for l in body]
+
+            yield "@@ -%d,%d +%d,%d @@\n" % (start + 1, end - start, start + 1, end - start) + "".join(body)
+            num_diffs += 1
+
+
+def load_hunks(input_dir, num_hunks):
+    jsonl_files = glob(os.path.join(input_dir, "*.jsonl.gz")) + glob(os.path.join(input_dir, "*.jsonl"))
+    diffs = (entry["diff"] for entry in iter_jsonl_gz(jsonl_files))
+    hunks = (clean_hunk(hunk) for diff in diffs for hunk in parse_hunks(diff))
+    return list(islice(hunks, num_hunks))
+
+
+# Implementations ----------------------------------------------------------------
+
+def previous_compute_diff(hunk):
+    # Escalation loop before HunkProcessor. Every level recomputes the edit script.
+    diff = cd.difference(hunk.before, hunk.after, lang = "python")
+    sstub_pattern = diff.sstub_pattern()
+    edit_scripts  = 0
+
+    level_diff = diff
+    for level in range(len(EDIT_LEVELS)):
+        edit_script = level_diff.edit_script()
+        edit_scripts += 1
+        if not _is_ghost_script(edit_script): break
+
+        if level == 0:
+            try:
+                level_diff = level_diff.statement_diff()
+            except Exception:
+                pass
+        elif level == 1:
+            level_diff = level_diff.root_diff()
+
+    try:
+        stmt_diff = diff.statement_diff()
+        before, after = stmt_diff.source_text, stmt_diff.target_text
+    except ValueError:
+        before, after = diff.source_text, diff.target_text
+
+    return (before, after, sstub_pattern.name, json_serialize(edit_script)), edit_scripts
+
+
+def processor_compute_diff(hunk):
+    processor = HunkProcessor(hunk, lang = "python")
+    sstub_pattern = processor.sstub_pattern()
+    edit_script = processor.edit_script()
+    before, after = processor.changed_text()
+
+    result = (before, after, sstub_pattern.name, json_serialize(edit_script))
+    return result, len(processor._edit_scripts), EDIT_LEVELS[processor.edit_level]
+
+
+def run_hunks(compute, hunks):
+    times, results = [], []
+
+    for hunk in hunks:
+        start_time = time.perf_counter()
+        try:
+            result = compute(hunk)
+        except Exception:
+            result = None
+        times.append(time.perf_counter() - start_time)
+        results.append(result)
+
+    return times, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir")
+    parser.add_argument("--num_hunks", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.input_dir:
+        hunks = load_hunks(args.input_dir, args.num_hunks)
+    else:
+        hunks = [clean_hunk(parse_hunks(diff)[0]) for diff in synthetic_diffs(args.num_hunks, args.seed)]
+
+    run_hunks(processor_compute_diff, hunks[:1]) # Loads the parser
+
+    previous_times, processor_times = [float("inf")] * len(hunks), [float("inf")] * len(hunks)
+    for _ in range(args.repeats):
+        times, previous_results = run_hunks(previous_compute_diff, hunks)
+        previous_times = list(map(min, previous_times, times))
+
+        times, processor_results = run_hunks(processor_compute_diff, hunks)
+        processor_times = list(map(min, processor_times, times))
+
+    levels = Counter(result[2] for result in processor_results if result is not None)
+    escalated = [i for i, result in enumerate(processor_results) if result is not None and result[2] != "diff"]
+
+    # code_diff does not always return the same edit script for hunks that need a larger diff level.
+    # Therefore, a few results can differ between runs of the same implementation.
+    same = sum((p is None and q is None) or (p is not None and q is not None and p[0] == q[0])
+                for p, q in zip(previous_results, processor_results))
+
+    print("Benchmark on %d hunks (best of %d runs)" % (len(hunks), args.repeats))
+    print("Edit levels: %s" % ", ".join("%s=%d" % (level, levels[level]) for level in EDIT_LEVELS))
+    print("Edit scripts computed: previous %d, processor %d" % (
+        sum(result[1] for result in previous_results if result is not None),
+        sum(result[1] for result in processor_results if result is not None),
+    ))
+    print("Same results: %d / %d" % (same, len(hunks)))
+    print("%-10s\t| %-12s\t| %-12s" % ("", "All (s)", "Escalated (s)"))
+    print("-----------------------------------------------------")
+    print("%-10s\t| %-12.2f\t| %-12.3f" % ("previous", sum(previous_times), sum(previous_times[i] for i in escalated)))
+    print("%-10s\t| %-12.2f\t| %-12.3f" % ("processor", sum(processor_times), sum(processor_times[i] for i in escalated)))
+
+
+if __name__ == '__main__':
+    main()
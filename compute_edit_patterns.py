@@ -2,16 +2,14 @@ from mapreduce import mapreduce
 import json
 
 from collections import defaultdict
-from tssb_miner.edit_abstraction import abstract_edit_script
+from tssb_miner.edit_encoding import edit_pattern
 
 
 def slc_to_pattern(slc):
     if not slc["likely_bug"]: return []
     if slc["comodified"]: return []
 
-    edit_script = json.loads(slc['edit_script'])
-    edit_pattern = tuple("%s_%s" % x for x in abstract_edit_script(edit_script))
-    return [(edit_pattern, slc["sstub_pattern"])]
+    return [(tuple(edit_pattern(slc)), slc["sstub_pattern"])]
 
 # Collect --------------------------------
 
@@ -2,6 +2,10 @@ from mapreduce import mapreduce
 
 from pydriller import Repository
 
+from tssb_miner.mirror_cache import MirrorCache
+
+MIRROR_CACHE = None
+
 # Need to be implemented --------------------------------
 
 def visit_buggy_commit(commit_slc, commit_obj, modfile):
@@ -45,7 +49,15 @@ def download_code_for_slc(slcs):
 
     hash_to_slc = {slc["commit_sha"]: slc for slc in slcs}
 
-    repo = Repository(request_url, only_commits=list(hash_to_slc.keys()))
+    if MIRROR_CACHE is not None:
+        with MIRROR_CACHE.open(request_url) as mirror_path:
+            return visit_commits(mirror_path, hash_to_slc)
+
+    return visit_commits(request_url, hash_to_slc)
+
+
+def visit_commits(repo_path, hash_to_slc):
+    repo = Repository(repo_path, only_commits=list(hash_to_slc.keys()))
 
     output = []
     for commit in repo.traverse_commits():
@@ -68,6 +80,22 @@ def try_download_slcs(slcs):
         print(e)
         return []
 
+
+# Mirror cache ------------------------------------------
+
+def add_mirror_arguments(parser):
+    parser.add_argument("--mirror_dir", help="Cache of mirror clones (e.g. shared with the crawler)")
+    parser.add_argument("--mirror_budget_gb", type=float, help="Maximal size of the mirror cache")
+
+
+def init_mirror_cache(args):
+    global MIRROR_CACHE
+    if not args.mirror_dir: return
+
+    max_bytes = args.mirror_budget_gb * 1e9 if args.mirror_budget_gb else None
+    MIRROR_CACHE = MirrorCache(args.mirror_dir, max_bytes = max_bytes)
+
     
 if __name__ == '__main__':
-    mapreduce(try_download_slcs, group_by = lambda slc: slc["project_url"])
\ No newline at end of file
+    mapreduce(try_download_slcs, group_by = lambda slc: slc["project_url"],
+                initializer = init_mirror_cache, add_arguments = add_mirror_arguments)
\ No newline at end of file
@@ -1,78 +1,475 @@
 import os
+import re
 import argparse
 import gzip
 import json
+import time
+import heapq
+import pickle
+import random
+import tempfile
+import traceback
 import multiprocessing as mp
+import multiprocessing.connection as mp_connection
 
 from glob import glob
 from tqdm import tqdm
+from bisect import bisect_right
+from itertools import islice, groupby
+from operator import itemgetter
+from functools import partial
+from collections import namedtuple
 
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext, ExitStack
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Codecs ----------------------------------------------------------------
+# Decoding and encoding JSON dominates the runtime of cheap map functions (e.g. filters).
+# Codecs use orjson if it is installed and fall back to the json module otherwise.
+
+class JsonCodec:
+
+    def __init__(self, backend = "auto"):
+        if backend == "auto": backend = "orjson" if orjson is not None else "json"
+        if backend == "orjson" and orjson is None: raise ValueError("orjson is not installed")
+        self.backend = backend
+
+    def decode(self, line):
+        if self.backend == "orjson": return orjson.loads(line)
+        return json.loads(line)
+
+    def encode(self, obj):
+        if self.backend == "orjson":
+            try:
+                return orjson.dumps(obj, option = orjson.OPT_APPEND_NEWLINE)
+            except TypeError: # e.g. non string keys
+                pass
+        
+        return (json.dumps(obj) + "\n").encode("utf-8")
+
+
+# Schema of dataset entries: (field, type, required). 
+# Later stages add fields (e.g. edit_level), which are kept without checks.
+SLC_SCHEMA = [
+    ("project"      , str , True),
+    ("commit_sha"   , str , True),
+    ("parent_sha"   , str , True),
+    ("file_path"    , str , True),
+    ("project_url"  , str , True),
+    ("likely_bug"   , bool, True),
+    ("comodified"   , bool, True),
+    ("in_function"  , bool, True),
+    ("sstub_pattern", str , False),
+    ("diff"         , str , True),
+    ("before"       , str , False),
+    ("after"        , str , False),
+    ("edit_script"  , str , False),
+]
+
+
+class SLCCodec(JsonCodec):
+    """
+    Typed codec for dataset entries (see SLC_SCHEMA).
+
+    Decoded entries are checked against the schema: required fields have to be present
+    and all schema fields have to be of their type. Entries are encoded with the schema fields 
+    in schema order, followed by all other fields. With the json backend, fields are encoded 
+    one by one with pre-encoded keys, which avoids the setup of json.dumps for every entry.
+
+    Entries of a dataset share a few layouts (fields, their order and value types). 
+    Checks and key orders are therefore computed once per layout.
+    """
+
+    def __init__(self, backend = "auto"):
+        super().__init__(backend)
+        self.schema_types = {field: field_type for field, field_type, _ in SLC_SCHEMA}
+        self.schema_order = {field: i for i, (field, _, _) in enumerate(SLC_SCHEMA)}
+        self.required     = [field for field, _, required in SLC_SCHEMA if required]
+
+        self._checked      = {} # layout -> value types that match the schema
+        self._encode_plans = {} # layout -> key order
+
+    def _check(self, entry, layout, types):
+        missing = [field for field in self.required if field not in entry]
+        if missing: raise ValueError("Entry misses required fields %s" % ", ".join(missing))
+
+        for field, value_type in zip(layout, types):
+            field_type = self.schema_types.get(field)
+            if field_type is not None and value_type is not field_type and value_type is not type(None):
+                raise ValueError("Field %s of entry is %s instead of %s" % (field, value_type.__name__, field_type.__name__))
+
+        self._checked.setdefault(layout, set()).add(types)
+
+    def decode(self, line):
+        entry = orjson.loads(line) if self.backend == "orjson" else json.loads(line)
+
+        # Only fields and value types that were not seen before are checked
+        layout = tuple(entry)
+        types  = tuple(map(type, entry.values()))
+        if types not in self._checked.get(layout, ()): self._check(entry, layout, types)
+
+        return entry
+
+    def _encode_plan(self, layout):
+        # Schema fields first, all other fields in their original order
+        order = sorted(layout, key = lambda field: (self.schema_order.get(field, len(self.schema_order)), layout.index(field)))
+        plan  = (None if order == list(layout) else order, 
+                    [(field, encode_basestring_ascii(field) + ": ") for field in order])
+        self._encode_plans[layout] = plan
+        return plan
+
+    def encode(self, obj):
+        layout = tuple(obj)
+
+        plan = self._encode_plans.get(layout)
+        if plan is None: plan = self._encode_plan(layout)
+        order, keys = plan
+
+        if self.backend == "orjson":
+            if order is not None: obj = {field: obj[field] for field in order}
+            return super().encode(obj)
+
+        fields = []
+        for field, key in keys:
+            value = obj[field]
+            if value.__class__ is str: fields.append(key + encode_basestring_ascii(value))
+            elif value is True:        fields.append(key + "true")
+            elif value is False:       fields.append(key + "false")
+            else:                      fields.append(key + json.dumps(value))
+
+        return ("{" + ", ".join(fields) + "}\n").encode("utf-8")
+
+
+CODECS = {
+    "json": partial(JsonCodec, "json"),
+    "fast": JsonCodec,
+    "slc" : SLCCodec,
+}
+
+
+def get_codec(name = "json"):
+    if name not in CODECS:
+        raise ValueError("Unknown codec %s. Available: %s" % (name, ", ".join(CODECS)))
+    return CODECS[name]()
 
 
 # Load files ----------------------------------------------------------------
 
-def iter_jsonl_gz(jsonl_file_paths):
+def iter_jsonl_gz(jsonl_file_paths, codec = None):
+    if codec is None: codec = get_codec()
+
     for path in jsonl_file_paths:
-        open_fn = gzip.open(path, 'r') if path.endswith('gz') else open(path)
+        open_fn = gzip.open(path, 'r') if path.endswith('gz') else open(path, 'rb')
         with open_fn as lines:
             for line in lines:
-                yield json.loads(line)
+                METRICS.counts["bytes_read"] += len(line)
+                yield codec.decode(line)
+
+
+# Block gzip ----------------------------------------------------------------
+# Shards are saved as a sequence of independently compressed gzip members (blocks).
+# The result is still a valid gzip file for normal readers.
+# A sidecar index (<shard>.idx) maps record numbers and (commit_sha, file_path) 
+# to the offset of the block containing the record.
+
+def block_index_path(path):
+    return path + ".idx"
+
+
+def record_key(obj):
+    if not isinstance(obj, dict) or "commit_sha" not in obj: return None
+    return "%s:%s" % (obj["commit_sha"], obj.get("file_path", ""))
+
+
+class BlockGzWriter:
+
+    def __init__(self, path, block_size = 64e3):
+        self.path = path
+        self.block_size = block_size
+        self.file_handler = open(path, "wb")
+
+        self.buffer = []
+        self.buffer_size = 0
+        self.num_records = 0
+
+        self.blocks = [] # [offset, compressed size, first record, number of records]
+        self.keys   = {} # key -> [record number]
+
+    def write(self, data, key = None):
+        if key is not None:
+            self.keys.setdefault(key, []).append(self.num_records)
+
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        self.num_records += 1
+
+        if self.buffer_size >= self.block_size: self._flush_block()
+
+    def _flush_block(self):
+        if len(self.buffer) == 0: return
+
+        block = gzip.compress(b"".join(self.buffer), mtime = 0)
+        first_record = self.num_records - len(self.buffer)
+        self.blocks.append([self.file_handler.tell(), len(block), first_record, len(self.buffer)])
+        self.file_handler.write(block)
+
+        self.buffer = []
+        self.buffer_size = 0
+
+    def close(self):
+        if self.file_handler is None: return
+
+        self._flush_block()
+        if len(self.blocks) == 0:
+            self.file_handler.write(gzip.compress(b"", mtime = 0))
+        self.file_handler.close()
+        self.file_handler = None
+
+        with open(block_index_path(self.path), "w") as index:
+            json.dump({"records": self.num_records, "blocks": self.blocks, "keys": self.keys}, index)
+
+
+class BlockGzReader:
+    """
+    Random access to a block gzip shard via its sidecar index.
+
+    Records can be fetched by record number or by (commit_sha, file_path)
+    while decompressing only the containing block.
+    """
+
+    def __init__(self, path, codec = None):
+        self.path = path
+        self.codec = codec if codec is not None else get_codec()
+
+        with open(block_index_path(path), "r") as index:
+            index = json.load(index)
+
+        self.num_records = index["records"]
+        self.blocks = index["blocks"]
+        self.keys   = index["keys"]
+        self._first_records = [block[2] for block in self.blocks]
+
+        self.file_handler = open(path, "rb")
+
+    @staticmethod
+    def has_index(path):
+        return os.path.exists(block_index_path(path))
+
+    def __len__(self):
+        return self.num_records
+
+    def read_block(self, block_id):
+        offset, size, _, _ = self.blocks[block_id]
+        self.file_handler.seek(offset)
+        block = gzip.decompress(self.file_handler.read(size))
+        METRICS.counts["bytes_read"] += len(block)
+        lines = block.splitlines()
+        return [self.codec.decode(line) for line in lines]
+
+    def iter_range(self, start, end):
+        # Iterates all blocks that start in the byte range [start, end)
+        for block_id, (offset, _, _, _) in enumerate(self.blocks):
+            if start <= offset < end: yield from self.read_block(block_id)
+
+    def get(self, record_number):
+        if not 0 <= record_number < self.num_records:
+            raise IndexError("Record %d is out of range for %s" % (record_number, self.path))
+
+        block_id = bisect_right(self._first_records, record_number) - 1
+        return self.read_block(block_id)[record_number - self._first_records[block_id]]
+
+    def find(self, commit_sha, file_path):
+        record_numbers = self.keys.get("%s:%s" % (commit_sha, file_path), [])
+        return [self.get(record_number) for record_number in record_numbers]
+
+    def close(self):
+        self.file_handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Input splits ----------------------------------------------------------------
+# Compressed shards can only be read as a whole, except block gzip shards
+# which are split at block boundaries.
+# Plain jsonl files are split into byte ranges. A line belongs to the range
+# that contains its first byte. Therefore, ranges do not need to be newline aligned.
+
+InputSplit = namedtuple("InputSplit", ["path", "start", "end"])
+
+
+def list_input_splits(jsonl_file_paths, split_bytes = 64e6):
+    splits = []
+
+    split_bytes = int(split_bytes)
+
+    for path in jsonl_file_paths:
+        if path.endswith("gz") and BlockGzReader.has_index(path):
+            splits.extend(_list_block_splits(path, split_bytes))
+            continue
+
+        if path.endswith("gz"):
+            splits.append(InputSplit(path, 0, None))
+            continue
+        
+        file_size = os.path.getsize(path)
+
+        for start in range(0, max(file_size, 1), split_bytes):
+            splits.append(InputSplit(path, start, min(start + split_bytes, file_size)))
+
+    return splits
+
+
+def _list_block_splits(path, split_bytes):
+    with BlockGzReader(path) as reader:
+        offsets = [block[0] for block in reader.blocks]
+
+    file_size = os.path.getsize(path)
+    if len(offsets) == 0: return [InputSplit(path, 0, file_size)]
+
+    starts = [0]
+    for offset in offsets:
+        if offset - starts[-1] >= split_bytes: starts.append(offset)
+
+    return [InputSplit(path, start, end) for start, end in zip(starts, starts[1:] + [file_size])]
+
+
+def iter_jsonl_split(split, codec = None):
+    if codec is None: codec = get_codec()
+
+    if split.end is None:
+        yield from iter_jsonl_gz([split.path], codec)
+        return
+
+    if split.path.endswith("gz"):
+        with BlockGzReader(split.path, codec) as reader:
+            yield from reader.iter_range(split.start, split.end)
+        return
+
+    with open(split.path, "rb") as lines:
+        if split.start > 0:
+            # Skip the line that started in the previous range
+            lines.seek(split.start - 1)
+            lines.readline()
+
+        while lines.tell() < split.end:
+            line = lines.readline()
+            if not line: break
+            METRICS.counts["bytes_read"] += len(line)
+            yield codec.decode(line)
 
 
 # Grouping ----------------------------------------------------------------
 
-class StreamGrouper:
+class ExternalGrouper:
+    """
+    Groups all instances that share the same key.
 
-    def __init__(self, group_by, buffer_size = 1e3):
+    Instances are buffered until the memory budget is exceeded. Then, the buffer is
+    sorted by key and spilled to disk as a sorted run. In the end, all runs are merged
+    such that every key is emitted exactly once together with its complete group
+    (independent of where its instances appear in the input).
+    Within a group, instances keep their input order. Keys have to be sortable.
+    """
+
+    def __init__(self, group_by, memory_budget = 1e9, tmp_dir = None, max_open_runs = 256):
         self.group_by = group_by
-        self.buffer_size = buffer_size
+        self.memory_budget = memory_budget
+        self.tmp_dir = tmp_dir
+        self.max_open_runs = max_open_runs
+
+        self.num_runs = 0
+
+    def _spill(self, buffer, run_dir):
+        buffer.sort(key = itemgetter(0))
+        return self._write_run(buffer, run_dir)
 
-        self.key_queue  = []
-        self.key_groups = {}
+    def _write_run(self, entries, run_dir):
+        run_path = os.path.join(run_dir, "run-%d.pkl" % self.num_runs)
+        self.num_runs += 1
 
-    def _add_to_group(self, instance):
-        instance_key = self.group_by(instance)
+        with open(run_path, "wb") as run_file:
+            for entry in entries:
+                pickle.dump(entry, run_file, protocol = pickle.HIGHEST_PROTOCOL)
 
-        if instance_key not in self.key_groups:
-            self.key_groups[instance_key] = []
-            self.key_queue.append(instance_key)
+        return run_path
+
+    def _read_run(self, run_path):
+        with open(run_path, "rb") as run_file:
+            while True:
+                try:
+                    yield pickle.load(run_file)
+                except EOFError:
+                    break
         
-        self.key_groups[instance_key].append(instance)
+        os.remove(run_path)
 
-    def __call__(self, instance_stream):
+    def _merge_runs(self, runs, run_dir):
+        # Merge runs in multiple passes if there are too many to open at once.
+        # The merged run replaces the earliest runs to preserve the input order.
+        while len(runs) > self.max_open_runs:
+            merged = heapq.merge(*[self._read_run(run) for run in runs[:self.max_open_runs]], key = itemgetter(0))
+            runs = [self._write_run(merged, run_dir)] + runs[self.max_open_runs:]
         
-        for instance in instance_stream:
-            self._add_to_group(instance)
+        return heapq.merge(*[self._read_run(run) for run in runs], key = itemgetter(0))
+
+    def __call__(self, instance_stream):
+        buffer, buffer_bytes, runs = [], 0, []
+
+        with tempfile.TemporaryDirectory(prefix = "groups-", dir = self.tmp_dir) as run_dir:
+
+            for instance in instance_stream:
+                payload = pickle.dumps(instance, protocol = pickle.HIGHEST_PROTOCOL)
+                buffer.append((self.group_by(instance), payload))
+                buffer_bytes += len(payload) + 128 # Estimated overhead per entry
+
+                if buffer_bytes >= self.memory_budget:
+                    runs.append(self._spill(buffer, run_dir))
+                    buffer, buffer_bytes = [], 0
 
-            if len(self.key_queue) > self.buffer_size:
-                emit_key = self.key_queue.pop(0)
-                yield self.key_groups[emit_key]
-                del self.key_groups[emit_key]
+            if len(runs) == 0:
+                buffer.sort(key = itemgetter(0))
+                entries = buffer
+            else:
+                if len(buffer) > 0: runs.append(self._spill(buffer, run_dir))
+                buffer = None
+                entries = self._merge_runs(runs, run_dir)
 
-        while len(self.key_queue) > 0:
-            emit_key = self.key_queue.pop(0)
-            yield self.key_groups[emit_key]
-            del self.key_groups[emit_key]
+            for _, group in groupby(entries, key = itemgetter(0)):
+                yield [pickle.loads(payload) for _, payload in group]
 
 
 # Jsonl Gz reduce --------------------------------------------------------------------
 
 class JsonlGzSaver:
 
-    def __init__(self, save_dir, num_objects = 1e5):
+    def __init__(self, save_dir, num_objects = 1e5, prefix = "file", codec = None, block_size = None):
         self.save_dir = save_dir
         self.num_objects = num_objects
+        self.prefix = prefix
+        self.codec = codec if codec is not None else get_codec()
+        self.block_size = block_size
+        os.makedirs(save_dir, exist_ok = True)
         
         self.object_count = 0
         self.file_count   = 0
+        self.shards       = [] # [file path, number of objects]
 
         self.file_handler = None
         self._find_unique_index()
         self._update_handler()
 
     def _file_path(self):
-        return os.path.join(self.save_dir, "file-%d.jsonl.gz" % self.file_count)
+        return os.path.join(self.save_dir, "%s-%d.jsonl.gz" % (self.prefix, self.file_count))
 
     def _find_unique_index(self):
         while os.path.exists(self._file_path()):
@@ -87,16 +484,33 @@ class JsonlGzSaver:
 
         if self.file_handler is not None: self.file_handler.close()
 
-        self.file_handler = gzip.open(file_path, "wb")
+        if self.block_size:
+            self.file_handler = BlockGzWriter(file_path, self.block_size)
+        else:
+            self.file_handler = gzip.open(file_path, "wb")
+        self.shards.append([file_path, 0])
         self.file_count += 1
         self.object_count = 0
 
+    @property
+    def saved_files(self):
+        return [file_path for file_path, _ in self.shards]
+
     def save(self, obj):
-        json_obj = json.dumps(obj) + "\n"
-        self.file_handler.write(json_obj.encode("utf-8"))
+        encoded = self.codec.encode(obj)
+        METRICS.counts["bytes_written"] += len(encoded)
+
+        if self.block_size:
+            self.file_handler.write(encoded, record_key(obj))
+        else:
+            self.file_handler.write(encoded)
         self.object_count += 1
+        self.shards[-1][1] += 1
         self._update_handler()
 
+    def __call__(self, obj):
+        self.save(obj)
+
     def close(self):
         if self.file_handler is not None:
             self.file_handler.close()
@@ -104,73 +518,1318 @@ class JsonlGzSaver:
 
 
 @contextmanager
-def jsonl_reduce_io(output_dir):
-    saver = JsonlGzSaver(output_dir)
+def jsonl_reduce_io(output_dir, prefix = "file", codec = None, block_size = None):
+    saver = JsonlGzSaver(output_dir, prefix = prefix, codec = codec, block_size = block_size)
     try:
-        
-        def call_save(obj):
-            saver.save(obj)
+        yield saver
+    finally:
+        saver.close()
+
 
-        yield call_save
+# Tee routing ----------------------------------------------------------------
+
+class TeeChain:
+    """
+    Applies a chain of named map functions in a single pass.
+
+    Every stage is applied to the outputs of the previous stage.
+    An output is tagged with the name of each stage it passes,
+    e.g. a record that passes all stages is emitted once per stage.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def __call__(self, instance):
+        routed_instances = []
+        instances = [instance]
+
+        for name, map_fn in self.stages:
+            instances = [output for instance in instances 
+                            for output in map_fn(instance) if output is not None]
+            if len(instances) == 0: break
+
+            routed_instances.extend((name, output) for output in instances)
+
+        return routed_instances
+
+
+class TeeSaver:
+
+    def __init__(self, output_dirs, **kwargs):
+        self.savers = {name: JsonlGzSaver(output_dir, **kwargs) 
+                        for name, output_dir in output_dirs.items()}
+
+    @property
+    def shards(self):
+        return [shard for saver in self.savers.values() for shard in saver.shards]
+
+    @property
+    def saved_files(self):
+        return [path for saver in self.savers.values() for path in saver.saved_files]
+
+    def __call__(self, routed_obj):
+        name, obj = routed_obj
+        if name not in self.savers: return
+        self.savers[name].save(obj)
+
+    def close(self):
+        for saver in self.savers.values():
+            saver.close()
+
+
+@contextmanager
+def jsonl_tee_reduce_io(output_dirs, prefix = "file", codec = None, block_size = None):
+    saver = TeeSaver(output_dirs, prefix = prefix, codec = codec, block_size = block_size)
+    try:
+        yield saver
     finally:
         saver.close()
 
+
+# Shard manifest ----------------------------------------------------------------
+
+class ShardManifest:
+    """
+    Lists all output shards of a directory with their number of records and size in bytes.
+
+    The manifest is saved as manifest.json. Readers can plan their work 
+    from the manifest without opening every shard.
+    """
+
+    FILE_NAME = "manifest.json"
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.shards = {}
+
+    def _manifest_path(self):
+        return os.path.join(self.output_dir, self.FILE_NAME)
+
+    def load(self):
+        if not os.path.exists(self._manifest_path()): return self
+
+        with open(self._manifest_path(), "r") as manifest:
+            shards = json.load(manifest)["shards"]
+
+        # Shards might have been removed since the manifest was saved
+        self.shards = {shard["name"]: shard for shard in shards 
+                        if os.path.exists(os.path.join(self.output_dir, shard["name"]))}
+        return self
+
+    def add(self, file_path, num_records):
+        name = os.path.basename(file_path)
+        self.shards[name] = {
+            "name": name,
+            "records": num_records,
+            "bytes": os.path.getsize(file_path)
+        }
+
+    def save(self):
+        shards = sorted(self.shards.values(), key = lambda shard: shard["name"])
+        manifest_path = self._manifest_path()
+
+        with open(manifest_path + ".tmp", "w") as manifest:
+            json.dump({
+                "records": sum(shard["records"] for shard in shards),
+                "bytes": sum(shard["bytes"] for shard in shards),
+                "shards": shards
+            }, manifest, indent = 1)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def update_shard_manifests(shards):
+    shards_per_dir = {}
+    for file_path, num_records in shards:
+        shards_per_dir.setdefault(os.path.dirname(file_path), []).append((file_path, num_records))
+
+    for output_dir, dir_shards in shards_per_dir.items():
+        manifest = ShardManifest(output_dir).load()
+        for file_path, num_records in dir_shards:
+            manifest.add(file_path, num_records)
+        manifest.save()
+
+
+class WorkerSaverMap:
+    """
+    Maps instances and saves the outputs inside the worker process.
+
+    Every worker saves to its own shards. Only the number of saved
+    outputs is sent back to the parent process.
+    """
+
+    def __init__(self, map_fn, reduce_io):
+        self.map_fn = map_fn
+        self.reduce_io = reduce_io
+        
+        self._reduce_stack = None
+        self._reduce_fn = None
+
+    def __call__(self, instance):
+        if self._reduce_fn is None:
+            self._reduce_stack = ExitStack()
+            self._reduce_fn = self._reduce_stack.enter_context(self.reduce_io(prefix = "file-w%d" % os.getpid()))
+
+        num_outputs = 0
+        for mapped_instance in self.map_fn(instance):
+            if mapped_instance is None: continue
+            self._reduce_fn(mapped_instance)
+            num_outputs += 1
+
+        return [num_outputs]
+
+    def close(self):
+        if self._reduce_fn is None: return []
+
+        self._reduce_stack.close()
+        return self._reduce_fn.shards
+
+# Metrics ----------------------------------------------------------------
+# Every process counts into its own METRICS instance. Workers send their
+# counts with every batch result and the parent process merges them.
+
+def _latency_bucket(latency):
+    return 1 << int(latency * 1e6).bit_length()
+
+
+def _bucket_percentile(buckets, percentile):
+    total = sum(buckets.values())
+    if total == 0: return 0.0
+
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= percentile * total: return bucket / 1e6
+    return 0.0
+
+
+class PipelineMetrics:
+    """
+    Counts records and (uncompressed) bytes flowing through a pipeline
+    and collects a histogram of per-record map latencies.
+
+    Latencies are bucketed by powers of two in microseconds (us).
+    Spans of traced stages (see Tracer) are collected in the same way per stage.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {
+            "records_in": 0, "records_out": 0, "records_dropped": 0,
+            "bytes_read": 0, "bytes_written": 0, "map_time": 0.0
+        }
+        self.latency_buckets = {} # upper bound in us -> number of records
+        self.spans = {} # stage -> [number of spans, total time, latency buckets]
+
+    def count(self, name, n = 1):
+        # Script specific counters (e.g. cache hits) are merged like all other counts
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def observe_map(self, latency, num_outputs):
+        counts = self.counts
+        counts["records_in"]  += 1
+        counts["records_out"] += num_outputs
+        counts["map_time"]    += latency
+        if num_outputs == 0: counts["records_dropped"] += 1
+
+        bucket = _latency_bucket(latency)
+        self.latency_buckets[bucket] = self.latency_buckets.get(bucket, 0) + 1
+
+    def observe_span(self, stage, latency):
+        span = self.spans.get(stage)
+        if span is None: span = self.spans[stage] = [0, 0.0, {}]
+
+        span[0] += 1
+        span[1] += latency
+        bucket = _latency_bucket(latency)
+        span[2][bucket] = span[2].get(bucket, 0) + 1
+
+    def pop(self):
+        snapshot = (self.counts, self.latency_buckets, self.spans)
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        counts, latency_buckets, spans = snapshot
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        for bucket, count in latency_buckets.items():
+            self.latency_buckets[bucket] = self.latency_buckets.get(bucket, 0) + count
+
+        for stage, (num_spans, total_time, buckets) in spans.items():
+            span = self.spans.get(stage)
+            if span is None: span = self.spans[stage] = [0, 0.0, {}]
+            span[0] += num_spans
+            span[1] += total_time
+            for bucket, count in buckets.items():
+                span[2][bucket] = span[2].get(bucket, 0) + count
+
+    def latency_percentile(self, percentile):
+        return _bucket_percentile(self.latency_buckets, percentile)
+
+
+METRICS = PipelineMetrics()
+
+
+# Tracing ----------------------------------------------------------------
+# Map functions can time their stages with `with TRACER.span("stage"): ...`.
+# Only a sample of records is traced. For all other records (and if tracing is off),
+# span returns a shared no-op context. An untraced span still costs a method call and
+# the with statement (about 0.25us), which is negligible for stages that parse or diff code
+# but not for stages in tight loops.
+
+class _NoSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Span:
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        METRICS.observe_span(self.stage, time.perf_counter() - self.start_time)
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """Times stages of sampled records. Spans are aggregated in METRICS of each process."""
+
+    def __init__(self):
+        self.sampled = False # Whether the current record is traced
+
+    def span(self, stage):
+        if not self.sampled: return NO_SPAN
+        return _Span(stage)
+
+
+TRACER = Tracer()
+
+
+class MeasuredMap:
+    """
+    Counts inputs, outputs and dropped records of a map function and measures its latency.
+
+    A fraction of trace_rate records is traced (see Tracer).
+    """
+
+    def __init__(self, map_fn, trace_rate = 0.0):
+        self.map_fn = map_fn
+        self.trace_rate = trace_rate
+
+    def __call__(self, instance):
+        if self.trace_rate > 0: TRACER.sampled = random.random() < self.trace_rate
+
+        start_time = time.perf_counter()
+        outputs = list(self.map_fn(instance))
+        latency = time.perf_counter() - start_time
+
+        METRICS.observe_map(latency, sum(1 for output in outputs if output is not None))
+        return outputs
+
+
+class MetricsReporter:
+    """
+    Periodically saves the pipeline metrics as JSON and prints a summary at the end.
+
+    Worker utilisation is the fraction of wall time workers spent in map functions.
+    """
+
+    def __init__(self, metrics_file = None, flush_interval = 10.0):
+        self.metrics_file = metrics_file
+        self.flush_interval = flush_interval
+        self.executor = None # Set for parallel runs
+
+        METRICS.reset()
+        self.start_time = time.time()
+        self.last_flush = self.start_time
+
+    def snapshot(self):
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        counts  = METRICS.counts
+
+        if self.executor is not None:
+            utilisation = [busy_time / elapsed for busy_time in self.executor.worker_busy]
+        else:
+            utilisation = [counts["map_time"] / elapsed]
+
+        return {
+            "elapsed": elapsed,
+            "counts": dict(counts),
+            "rates": {
+                "records_in_per_s": counts["records_in"] / elapsed,
+                "records_out_per_s": counts["records_out"] / elapsed,
+                "bytes_read_per_s": counts["bytes_read"] / elapsed,
+                "bytes_written_per_s": counts["bytes_written"] / elapsed,
+            },
+            "latency": {
+                "p50": METRICS.latency_percentile(0.5),
+                "p90": METRICS.latency_percentile(0.9),
+                "p99": METRICS.latency_percentile(0.99),
+                "buckets_us": {str(bucket): count for bucket, count in sorted(METRICS.latency_buckets.items())},
+            },
+            "worker_utilisation": utilisation,
+            "spans": {
+                stage: {"count": num_spans, "time": total_time, 
+                        "p50": _bucket_percentile(buckets, 0.5), "p99": _bucket_percentile(buckets, 0.99)}
+                for stage, (num_spans, total_time, buckets) in METRICS.spans.items()
+            }
+        }
+
+    def tick(self):
+        if self.metrics_file is None: return
+        if time.time() - self.last_flush < self.flush_interval: return
+        self.flush()
+
+    def flush(self):
+        if self.metrics_file is None: return
+        self.last_flush = time.time()
+
+        with open(self.metrics_file + ".tmp", "w") as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent = 1)
+        os.replace(self.metrics_file + ".tmp", self.metrics_file)
+
+    def summary(self):
+        self.flush()
+        snapshot = self.snapshot()
+        counts, rates, latency = snapshot["counts"], snapshot["rates"], snapshot["latency"]
+        utilisation = snapshot["worker_utilisation"]
+
+        print("Records:         \t%d in (%.0f/s) | %d out (%.0f/s) | %d dropped" % (
+                    counts["records_in"], rates["records_in_per_s"], 
+                    counts["records_out"], rates["records_out_per_s"], counts["records_dropped"]
+        ))
+        print("Bytes:           \t%.1f MB read (%.1f MB/s) | %.1f MB written (%.1f MB/s)" % (
+                    counts["bytes_read"] / 1e6, rates["bytes_read_per_s"] / 1e6,
+                    counts["bytes_written"] / 1e6, rates["bytes_written_per_s"] / 1e6
+        ))
+        print("Map latency:     \tp50 < %d us | p90 < %d us | p99 < %d us" % (
+                    1e6 * latency["p50"], 1e6 * latency["p90"], 1e6 * latency["p99"]
+        ))
+        print("Worker util.:    \t%.0f%% avg / %.0f%% min / %.0f%% max" % (
+                    100 * sum(utilisation) / len(utilisation), 100 * min(utilisation), 100 * max(utilisation)
+        ))
+
+        spans = snapshot["spans"]
+        traced_time = sum(span["time"] for span in spans.values())
+        for stage, span in sorted(spans.items(), key = lambda item: -item[1]["time"]):
+            print("Stage %-11s\t%5.1f%% | %d spans | mean %d us | p50 < %d us | p99 < %d us" % (
+                    stage + ":", 100 * span["time"] / max(traced_time, 1e-9), span["count"],
+                    1e6 * span["time"] / span["count"], 1e6 * span["p50"], 1e6 * span["p99"]
+            ))
+
+
 # Map multiprocessing ----------------------------------------------------------------
 
-def pmap(map_fn, data):
+class BatchSizeTuner:
+    """
+    Adapts the number of instances per batch to the measured map latency.
+
+    Batches are sized such that mapping a batch takes roughly target_time seconds.
+    This amortizes the IPC overhead for cheap map functions (e.g. filters)
+    while keeping batches of expensive map functions small.
+    """
+
+    def __init__(self, batch_size = None, target_time = 0.1, max_size = 1024, smoothing = 0.2):
+        self.fixed = batch_size is not None and batch_size > 0
+        self.batch_size = batch_size if self.fixed else 1
+        self.target_time = target_time
+        self.max_size = max_size
+        self.smoothing = smoothing
+
+        self.item_time = None
+
+    def update(self, num_instances, run_time):
+        if num_instances == 0: return
 
-    cpu_count = mp.cpu_count()
+        item_time = run_time / num_instances
 
-    if cpu_count <= 4: # Too few CPUs for multiprocessing
-        for output in map(map_fn, data):
-            yield output
+        if self.item_time is None:
+            self.item_time = item_time
+        else:
+            self.item_time += self.smoothing * (item_time - self.item_time)
+        
+        if self.fixed: return
+
+        batch_size = self.target_time / max(self.item_time, 1e-9)
+        self.batch_size = int(min(max(batch_size, 1), self.max_size))
+
+
+def _worker_loop(map_fn, initializer, initargs, task_queue, result_conn, progress = None):
+    METRICS.reset() # Forked workers inherit the counts of the parent
+    if initializer is not None: initializer(*initargs)
+
+    while True:
+        task = task_queue.get()
+        if task is None: 
+            # Map functions with state (e.g. open files) are closed on shutdown
+            if hasattr(map_fn, "close"): result_conn.send((None, map_fn.close(), 0.0, METRICS.pop()))
+            break
+
+        batch_id, payload = task
+        batch = pickle.loads(payload)
+
+        start_time = time.perf_counter()
+        try:
+            if progress is None:
+                outputs = [map_fn(instance) for instance in batch]
+            else:
+                outputs = []
+                for i, instance in enumerate(batch):
+                    # The watchdog of the parent knows which instance is mapped since when
+                    progress[0], progress[1], progress[2] = batch_id, i, time.time()
+                    outputs.append(map_fn(instance))
+                progress[2] = 0.0
+        except Exception:
+            result_conn.send((batch_id, None, traceback.format_exc(), None))
+            break
+
+        result_conn.send((batch_id, outputs, time.perf_counter() - start_time, METRICS.pop()))
+
+
+class QueueStats:
+    """
+    Tracks the number of batches in flight and where the parent process spends its time.
+
+    If the parent mostly waits for workers while the window is full, the run is CPU-bound.
+    If the window is mostly empty because the parent is busy reading, the run is I/O-bound.
+    """
+
+    def __init__(self, max_inflight, max_inflight_bytes = None):
+        self.max_inflight = max_inflight
+        self.max_inflight_bytes = max_inflight_bytes
+
+        self.num_samples = 0
+        self.depth_sum   = 0
+        self.max_depth   = 0
+        self.max_bytes   = 0
+
+        self.read_time   = 0.0
+        self.wait_time   = 0.0
+        self.reduce_time = 0.0
+
+    @property
+    def mean_depth(self):
+        return self.depth_sum / max(self.num_samples, 1)
+
+    def sample(self, depth, num_bytes):
+        self.num_samples += 1
+        self.depth_sum   += depth
+        self.max_depth    = max(self.max_depth, depth)
+        self.max_bytes    = max(self.max_bytes, num_bytes)
+
+    def bottleneck(self):
+        if self.wait_time >= max(self.read_time, self.reduce_time): return "CPU-bound (map)"
+        if self.read_time >= self.reduce_time: return "I/O-bound (read)"
+        return "I/O-bound (reduce)"
+
+    def report(self):
+        total_time = max(self.read_time + self.wait_time + self.reduce_time, 1e-9)
+        
+        print("Queue depth:     \t%.1f avg / %d max / %d limit (batches)" % (self.mean_depth, self.max_depth, self.max_inflight))
+        print("Max bytes queued:\t%.1f MB" % (self.max_bytes / 1e6))
+        print("Parent time:     \tread %.0f%% | wait for workers %.0f%% | reduce %.0f%%" % (
+                    100 * self.read_time / total_time, 100 * self.wait_time / total_time, 100 * self.reduce_time / total_time
+        ))
+        print("Bottleneck:      \t%s" % self.bottleneck())
+
+
+def _process_rss(pid):
+    # Resident memory of a process in bytes (Linux only)
+    try:
+        with open("/proc/%d/statm" % pid, "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class ProcessExecutor:
+    """
+    Maps instances in parallel by sending batches of instances to worker processes.
+
+    Each batch is pickled as a single payload. If no batch size is given, 
+    the batch size is tuned from the measured per-instance map latency.
+    The initializer is called once in every worker before the first batch
+    (e.g. to load parsers). If the map function has a close method, it is called 
+    in every worker on shutdown and the results are collected in close_results.
+
+    Instances are only read when a batch can be dispatched. At most max_inflight 
+    batches (and max_inflight_bytes pickled bytes) are in flight at any time.
+    Therefore, memory of the parent process stays bounded independent of the input size.
+    Outputs are yielded in order of completion. Metrics counted in the workers 
+    are merged into METRICS of the parent process.
+
+    If record_timeout (seconds) or max_rss_bytes is given, a watchdog kills workers
+    that map a single instance for too long or use too much memory (and workers that crash
+    while mapping an instance). The worker is replaced, its other batches are dispatched again
+    and the offending instance is passed to quarantine(instance, reason).
+    """
+
+    def __init__(self, map_fn, num_workers = None, initializer = None, initargs = (), 
+                    batch_size = None, target_batch_time = 0.1,
+                    max_inflight = None, max_inflight_bytes = None,
+                    record_timeout = None, max_rss_bytes = None, quarantine = None, watchdog_interval = 1.0):
+        self.map_fn = map_fn
+        self.num_workers = num_workers if num_workers else mp.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.tuner = BatchSizeTuner(batch_size, target_time = target_batch_time)
+
+        self.max_inflight = max_inflight if max_inflight else 2 * self.num_workers
+        self.max_inflight_bytes = max_inflight_bytes
+        self.stats = QueueStats(self.max_inflight, max_inflight_bytes)
+
+        self.record_timeout = record_timeout
+        self.max_rss_bytes = max_rss_bytes
+        self.quarantine = quarantine
+        self.watchdog_interval = watchdog_interval
+        self.watchdog = record_timeout is not None or max_rss_bytes is not None
+
+        self.workers = [None] * self.num_workers
+        self.close_results = []
+        self.worker_busy = [0.0] * self.num_workers
+        self.num_restarts = 0
+
+        self._pending  = {}  # batch_id -> (worker_id, batch size, payload size, payload)
+        self._inflight = [0] * self.num_workers
+        self._inflight_bytes = 0
+        self._next_batch_id  = 0
+        self._quarantined_outputs = []
+        self._last_check = 0.0
+
+    def _start_worker(self, worker_id):
+        # Every worker has its own result pipe. If a worker dies while sending,
+        # the partial message can be detected and does not block other workers.
+        task_queue = mp.Queue()
+        result_reader, result_writer = mp.Pipe(duplex = False)
+        progress = mp.Array("d", 3, lock = False) if self.watchdog else None
+
+        process = mp.Process(target = _worker_loop, 
+                                args = (self.map_fn, self.initializer, self.initargs, 
+                                        task_queue, result_writer, progress),
+                                daemon = True)
+        process.start()
+        result_writer.close()
+        self.workers[worker_id] = (process, task_queue, result_reader, progress)
+
+    def _start(self):
+        for worker_id in range(self.num_workers):
+            self._start_worker(worker_id)
+
+    def _shutdown(self, force = False):
+        for process, task_queue, _, _ in self.workers:
+            if force: process.terminate()
+            else:     task_queue.put(None)
+
+        for process, task_queue, result_reader, _ in self.workers:
+            if not force and hasattr(self.map_fn, "close"):
+                _, close_result, _, metrics = result_reader.recv()
+                self.close_results.append(close_result)
+                METRICS.merge(metrics)
+
+            process.join()
+            # Pending tasks of terminated workers are never consumed.
+            # Do not wait for them to be flushed on exit.
+            if force: task_queue.cancel_join_thread()
+            task_queue.close()
+            result_reader.close()
+
+        self.workers = [None] * self.num_workers
+
+    def _dispatch(self, batch, payload = None):
+        if payload is None: payload = pickle.dumps(batch, protocol = pickle.HIGHEST_PROTOCOL)
+
+        worker_id = min(range(self.num_workers), key = lambda i: self._inflight[i])
+        batch_id  = self._next_batch_id
+        self._next_batch_id += 1
+
+        self.workers[worker_id][1].put((batch_id, payload))
+        self._inflight[worker_id] += 1
+        self._inflight_bytes += len(payload)
+        self._pending[batch_id] = (worker_id, len(batch), len(payload), payload)
+
+    # Watchdog ----------------------------------------------------------------
+
+    def _replace_worker(self, worker_id, reason):
+        process, task_queue, result_reader, progress = self.workers[worker_id]
+
+        process.kill()
+        process.join()
+        batch_id, index, _ = progress[:] # Stable after the worker is killed
+        task_queue.cancel_join_thread()
+        task_queue.close()
+        result_reader.close()
+
+        self._start_worker(worker_id)
+        self.num_restarts += 1
+        self._inflight[worker_id] = 0
+
+        # Results of the killed worker are lost. Therefore, all its batches are dispatched again
+        # except for the instance that was mapped when the worker was killed.
+        batch_ids = sorted(pending_id for pending_id, pending in self._pending.items() if pending[0] == worker_id)
+
+        for pending_id in batch_ids:
+            _, _, payload_size, payload = self._pending.pop(pending_id)
+            self._inflight_bytes -= payload_size
+            batch = pickle.loads(payload)
+
+            if pending_id == int(batch_id):
+                self._quarantine(batch.pop(int(index)), reason)
+                if len(batch) == 0: continue
+                payload = None
+
+            self._dispatch(batch, payload)
+
+    def _quarantine(self, instance, reason):
+        print("Watchdog: Worker %s. Instance is quarantined." % reason)
+        METRICS.count("records_quarantined")
+
+        # The quarantine decides what is yielded instead of the mapped instance
+        if self.quarantine is None: return
+        output = self.quarantine(instance, reason)
+        if output is not None: self._quarantined_outputs.append(output)
+
+    def _check_workers(self):
+        now = time.time()
+        if now - self._last_check < self.watchdog_interval: return False
+        self._last_check = now
+
+        replaced = False
+        for worker_id, (process, _, _, progress) in enumerate(self.workers):
+            start_time = progress[2]
+            if start_time == 0: continue # Idle
+
+            reason = None
+            if self.record_timeout is not None and now - start_time > self.record_timeout:
+                reason = "timed out after %.1f seconds" % (now - start_time)
+
+            elif self.max_rss_bytes is not None:
+                rss = _process_rss(process.pid)
+                if rss > self.max_rss_bytes: reason = "exceeded memory limit with %.1f MB" % (rss / 1e6)
+
+            if reason is not None:
+                self._replace_worker(worker_id, reason)
+                replaced = True
+
+        return replaced
+
+    # ------------------------------------------------------------------------
+
+    def _next_result(self):
+        # Returns None if the watchdog replaced a worker
+        
+        while True:
+            if self.watchdog and self._check_workers(): return None
+
+            readers = [result_reader for _, _, result_reader, _ in self.workers]
+
+            for result_reader in mp_connection.wait(readers, timeout = self.watchdog_interval):
+                try:
+                    return result_reader.recv()
+                except EOFError:
+                    worker_id = readers.index(result_reader)
+                    process = self.workers[worker_id][0]
+                    process.join()
+
+                    # Only workers that die while mapping an instance are replaced
+                    if not self.watchdog or self.workers[worker_id][3][2] == 0:
+                        raise RuntimeError("Worker process %d died with exit code %s" % (process.pid, process.exitcode))
+                    
+                    self._replace_worker(worker_id, "crashed with exit code %s" % process.exitcode)
+                    return None
+
+    def _has_capacity(self, num_inflight, inflight_bytes):
+        if num_inflight == 0: return True
+        if num_inflight >= self.max_inflight: return False
+        
+        return self.max_inflight_bytes is None or inflight_bytes < self.max_inflight_bytes
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def map(self, instances):
+        instances = iter(instances)
+        exhausted = False
+
+        self._start()
+        try:
+            while True:
+
+                start_time = time.perf_counter()
+                while not exhausted and self._has_capacity(len(self._pending), self._inflight_bytes):
+                    batch = list(islice(instances, self.tuner.batch_size))
+                    if len(batch) == 0: exhausted = True; break
+                    self._dispatch(batch)
+                
+                self.stats.sample(len(self._pending), self._inflight_bytes)
+                self.stats.read_time += time.perf_counter() - start_time
+
+                while len(self._quarantined_outputs) > 0:
+                    yield self._quarantined_outputs.pop(0)
+                
+                if len(self._pending) == 0: break
+
+                start_time = time.perf_counter()
+                result = self._next_result()
+                self.stats.wait_time += time.perf_counter() - start_time
+                if result is None: continue # Worker was replaced
+
+                result_id, outputs, run_time, metrics = result
+
+                if outputs is None:
+                    raise RuntimeError("Map function failed in worker process:\n%s" % run_time)
+
+                worker_id, batch_size, payload_size, _ = self._pending.pop(result_id)
+                self._inflight[worker_id] -= 1
+                self._inflight_bytes -= payload_size
+                self.tuner.update(batch_size, run_time)
+                self.worker_busy[worker_id] += run_time
+                METRICS.merge(metrics)
+
+                start_time = time.perf_counter()
+                for output in outputs:
+                    yield output
+                self.stats.reduce_time += time.perf_counter() - start_time
+
+        except BaseException:
+            self._shutdown(force = True)
+            raise
+
+        self._shutdown()
+
+
+class Quarantine:
+    """
+    Saves instances the watchdog took away from a worker.
+
+    Instances are appended to quarantine-<pid>.jsonl.gz such that they can be 
+    inspected or mapped again. The reason is appended to reasons.jsonl.
+    Quarantined instances have no mapped outputs.
+    """
+
+    def __init__(self, quarantine_dir, codec = None):
+        self.quarantine_dir = quarantine_dir
+        self.codec = codec if codec is not None else JsonCodec()
+        self.num_instances = 0
+
+    def __call__(self, instance, reason):
+        os.makedirs(self.quarantine_dir, exist_ok = True)
+        file_name = "quarantine-%d.jsonl.gz" % os.getpid()
+
+        with gzip.open(os.path.join(self.quarantine_dir, file_name), "ab") as o:
+            o.write(self.codec.encode(instance))
+
+        with open(os.path.join(self.quarantine_dir, "reasons.jsonl"), "a") as o:
+            o.write(json.dumps({"file": file_name, "line": self.num_instances, "reason": reason}) + "\n")
+
+        self.num_instances += 1
+        return []
+
+
+def _quarantine_dir(args, output_dirs = None):
+    if args.quarantine_dir: return args.quarantine_dir
+    if output_dirs: return os.path.join(output_dirs[0], "quarantine")
+    return "quarantine"
+
+
+def _create_executor(args, map_fn, initializer = None, quarantine = None):
+    num_workers = args.parrallel if args.parrallel else mp.cpu_count()
+    if num_workers <= 1: return None
+
+    max_inflight_bytes = int(args.max_inflight_mb * 1e6) if args.max_inflight_mb else None
+    max_rss_bytes = int(args.max_worker_rss_mb * 1e6) if args.max_worker_rss_mb else None
+
+    return ProcessExecutor(map_fn, num_workers,
+                            initializer = initializer,
+                            initargs    = (args,),
+                            batch_size  = args.batch_size,
+                            max_inflight = args.max_inflight,
+                            max_inflight_bytes = max_inflight_bytes,
+                            record_timeout = args.record_timeout if args.record_timeout else None,
+                            max_rss_bytes  = max_rss_bytes,
+                            quarantine     = quarantine)
+
+
+def _has_watchdog(args):
+    return bool(args.record_timeout or args.max_worker_rss_mb)
+
+
+# Checkpoints ----------------------------------------------------------------
+
+class Checkpoint:
+    """
+    Manifest of all input splits that were completely processed.
+
+    The manifest is saved as checkpoint.json into every output directory
+    and lists the output shards produced for each completed split.
+    Output shards of splits (file-<split>-<n>.jsonl.gz) that are not listed 
+    in the manifest belong to an interrupted run and are removed on resume. 
+    Other files in the output directories are kept.
+    """
+
+    FILE_NAME = "checkpoint.json"
+    SHARD_PATTERN = re.compile(r"^file-\d+-\d+\.jsonl\.gz$") # Prefix of _run_checkpointed and ShardTask
+
+    def __init__(self, output_dirs):
+        self.output_dirs = list(output_dirs)
+        self.completed = {output_dir: {} for output_dir in self.output_dirs}
+
+    @staticmethod
+    def split_key(split):
+        return "%s:%d:%s" % (os.path.basename(split.path), split.start, split.end)
+
+    def _manifest_path(self, output_dir):
+        return os.path.join(output_dir, self.FILE_NAME)
+
+    def load(self):
+        for output_dir in self.output_dirs:
+            manifest_path = self._manifest_path(output_dir)
+            if not os.path.exists(manifest_path): continue
+
+            with open(manifest_path, "r") as manifest:
+                self.completed[output_dir] = json.load(manifest)["completed"]
+
+            # Remove outputs of splits that were not completed
+            listed_files = set(file_name for info in self.completed[output_dir].values() 
+                                            for file_name in info["outputs"])
+            
+            for file_path in glob(os.path.join(output_dir, "*.jsonl.gz")):
+                file_name = os.path.basename(file_path)
+                if self.SHARD_PATTERN.match(file_name) and file_name not in listed_files:
+                    os.remove(file_path)
+                    if BlockGzReader.has_index(file_path): 
+                        os.remove(block_index_path(file_path))
+
+        return self
+
+    def save(self):
+        for output_dir in self.output_dirs:
+            os.makedirs(output_dir, exist_ok = True)
+            manifest_path = self._manifest_path(output_dir)
+
+            with open(manifest_path + ".tmp", "w") as manifest:
+                json.dump({"completed": self.completed[output_dir]}, manifest, indent = 1)
+            os.replace(manifest_path + ".tmp", manifest_path)
+
+    def is_completed(self, split):
+        split_key = self.split_key(split)
+        return all(split_key in completed for completed in self.completed.values())
+
+    def complete(self, split, num_instances, saved_files):
+        split_key = self.split_key(split)
+
+        for output_dir in self.output_dirs:
+            outputs = [os.path.basename(path) for path in saved_files 
+                        if os.path.samefile(os.path.dirname(path), output_dir)]
+
+            self.completed[output_dir][split_key] = {
+                "instances": num_instances,
+                "outputs": outputs
+            }
+
+        self.save()
+
+
+class SplitTaggedMap:
+    """Keeps track of the input split each instance belongs to"""
+
+    def __init__(self, map_fn):
+        self.map_fn = map_fn
+
+    def __call__(self, tagged_instance):
+        split_id, instance = tagged_instance
+        return [(split_id, self.map_fn(instance))]
+
+
+def _iter_tagged_splits(tasks, codec, split_sizes):
+    for split_id, split in tasks:
+        num_instances = 0
+
+        for instance in iter_jsonl_split(split, codec):
+            num_instances += 1
+            yield split_id, instance
+
+        split_sizes[split_id] = num_instances
+
+
+def _run_checkpointed(args, map_fn, reduce_io, tasks, checkpoint, reporter, 
+                        initializer = None, total_records = None, quarantine = None):
+    # Outputs are saved per input split such that a split
+    # can be marked as completed as soon as all its instances are mapped.
+
+    splits = dict(tasks)
+    split_sizes, num_mapped, open_reducers = {}, {}, {}
+
+    instance_stream = _iter_tagged_splits(tasks, get_codec(args.codec), split_sizes)
+    tagged_map_fn   = SplitTaggedMap(map_fn)
+
+    def tagged_quarantine(tagged_instance, reason):
+        # A quarantined instance still counts as mapped for its split
+        split_id, instance = tagged_instance
+        return [(split_id, quarantine(instance, reason))]
+
+    executor = None
+    if args.parrallel is not None:
+        executor = _create_executor(args, tagged_map_fn, initializer = initializer,
+                                    quarantine = tagged_quarantine if quarantine is not None else None)
+        reporter.executor = executor
+
+    if executor is None:
+        if initializer is not None: initializer(args)
+        mapped_instance_stream = map(tagged_map_fn, instance_stream)
+    else:
+        mapped_instance_stream = executor.map(instance_stream)
+
+    def complete_splits():
+        for split_id, split_size in list(split_sizes.items()):
+            if num_mapped.get(split_id, 0) < split_size: continue
+
+            shards = []
+            if split_id in open_reducers:
+                reduce_stack, reduce_fn = open_reducers.pop(split_id)
+                reduce_stack.close()
+                shards = reduce_fn.shards
+
+            update_shard_manifests(shards)
+            checkpoint.complete(splits[split_id], split_size, [file_path for file_path, _ in shards])
+            del split_sizes[split_id]
+    
+    try:
+        for tagged_outputs in tqdm(mapped_instance_stream, total = total_records):
+            for split_id, mapped_instances in tagged_outputs:
+
+                if split_id not in open_reducers:
+                    reduce_stack = ExitStack()
+                    reduce_fn = reduce_stack.enter_context(reduce_io(prefix = "file-%d" % split_id))
+                    open_reducers[split_id] = (reduce_stack, reduce_fn)
+
+                reduce_fn = open_reducers[split_id][1]
+                for mapped_instance in mapped_instances:
+                    if mapped_instance is None: continue
+                    reduce_fn(mapped_instance)
+
+                num_mapped[split_id] = num_mapped.get(split_id, 0) + 1
+
+            complete_splits()
+            reporter.tick()
+        
+        complete_splits() # Empty splits
+    finally:
+        for reduce_stack, _ in open_reducers.values():
+            reduce_stack.close()
+
+    if executor is not None:
+        executor.stats.report()
+
+    if quarantine is not None and quarantine.num_instances > 0:
+        print("Quarantined %d instances in %s" % (quarantine.num_instances, quarantine.quarantine_dir))
+    reporter.summary()
+
+
+# Shard parallel ----------------------------------------------------------------
+
+class ShardTask:
+    """
+    Reads, maps and saves a complete input split inside a worker process.
+
+    Outputs are saved with a prefix unique to the split.
+    Therefore, workers never write to the same file.
+    """
+
+    def __init__(self, map_fn, reduce_io, codec = None):
+        self.map_fn = map_fn
+        self.reduce_io = reduce_io
+        self.codec = codec
+
+    def __call__(self, split_id_split):
+        split_id, split = split_id_split
+        num_instances = 0
+
+        with self.reduce_io(prefix = "file-%d" % split_id) as reduce_fn:
+            for instance in iter_jsonl_split(split, self.codec):
+                num_instances += 1
+
+                for mapped_instance in self.map_fn(instance):
+                    if mapped_instance is None: continue
+                    reduce_fn(mapped_instance)
+
+        return [(split_id, num_instances, reduce_fn.shards)]
+
+
+def _run_shard_parallel(args, map_fn, reduce_io, tasks, reporter, checkpoint = None, initializer = None):
+    shard_task = ShardTask(map_fn, reduce_io, get_codec(args.codec))
+
+    args.batch_size = 1 # Every split is a single task
+    if _has_watchdog(args):
+        print("Watchdog is not supported with --shard_parallel. Records are not quarantined.")
+        args.record_timeout, args.max_worker_rss_mb = None, None
+
+    executor = None
+    if args.parrallel is not None:
+        executor = _create_executor(args, shard_task, initializer = initializer)
+        reporter.executor = executor
+
+    if executor is None:
+        if initializer is not None: initializer(args)
+        task_stream = map(shard_task, tasks)
+    else:
+        task_stream = executor.map(tasks)
+
+    splits = dict(tasks)
+
+    num_instances = 0
+    for split_results in tqdm(task_stream, total = len(tasks), unit = "split"):
+        for split_id, split_instances, shards in split_results:
+            num_instances += split_instances
+            update_shard_manifests(shards)
+
+            if checkpoint is not None:
+                checkpoint.complete(splits[split_id], split_instances, 
+                                    [file_path for file_path, _ in shards])
+        reporter.tick()
+
+    print("Processed %d instances in %d splits" % (num_instances, len(tasks)))
+    reporter.summary()
 
-    with mp.Pool(processes = cpu_count) as pool:
-        for output in pool.imap_unordered(map_fn, data, chunksize = 4 * cpu_count):
-            yield output
 
 # API method ----------------------------------------------------------------
 
-def mapreduce(map_fn, reduce_fn = jsonl_reduce_io, group_by = None):
+def _add_pipeline_arguments(parser):
+    parser.add_argument("--group_memory_mb", type=float, default = 1000,
+                            help="Memory used for grouping before sorted runs are spilled to disk")
+    parser.add_argument("--group_tmp_dir",
+                            help="Directory for sorted runs during grouping (default: system tmp dir)")
+    parser.add_argument("--parrallel", type=int, nargs="?", const=0, default=None,
+                            help="Number of worker processes (default: all CPUs)")
+    parser.add_argument("--batch_size", type=int, default=0,
+                            help="Instances per worker task (default: tuned from map latency)")
+    parser.add_argument("--max_inflight", type=int, default=0,
+                            help="Maximal number of batches in flight (default: 2 per worker)")
+    parser.add_argument("--max_inflight_mb", type=float, default=0,
+                            help="Maximal size of pickled batches in flight in MB (default: unbounded)")
+    parser.add_argument("--shard_parallel", action="store_true",
+                            help="Read, map and save each input split inside a worker process")
+    parser.add_argument("--split_mb", type=float, default=64,
+                            help="Size of byte ranges plain jsonl files are split into for --shard_parallel")
+    parser.add_argument("--codec", choices=list(CODECS), default="json",
+                            help="JSON codec used for reading and saving instances")
+    parser.add_argument("--block_kb", type=float, default=0,
+                            help="Save outputs as block gzip with a record index using blocks of this size in KB (default: plain gzip)")
+    parser.add_argument("--metrics_file",
+                            help="Periodically save pipeline metrics (throughput, latency, utilisation) as JSON")
+    parser.add_argument("--metrics_interval", type=float, default=10,
+                            help="Seconds between saves of the metrics file")
+    parser.add_argument("--trace_rate", type=float, default=0,
+                            help="Fraction of records for which stages of the map function are timed (default: off)")
+    parser.add_argument("--resume", action="store_true",
+                            help="Record completed input splits in a checkpoint and skip them when restarted")
+    parser.add_argument("--record_timeout", type=float, default=0,
+                            help="Replace workers that map a single instance for more than this many seconds (default: no limit)")
+    parser.add_argument("--max_worker_rss_mb", type=float, default=0,
+                            help="Replace workers whose resident memory exceeds this many MB while mapping (default: no limit)")
+    parser.add_argument("--quarantine_dir",
+                            help="Directory for instances of replaced workers (default: <output_dir>/quarantine)")
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_dir")
 
-    if reduce_fn == jsonl_reduce_io:
-        parser.add_argument("output_dir")
+def _list_input_files(input_dir):
+    jsonl_files = glob(os.path.join(input_dir, "*.jsonl.gz"))
+    jsonl_files += glob(os.path.join(input_dir, "*.jsonl"))
+    return sorted(jsonl_files)
 
-    parser.add_argument("--group_buffer", type=int, default = 100)
-    parser.add_argument("--parrallel", action="store_true")
 
-    args = parser.parse_args()
+def _count_input_records(input_dir):
+    # Inputs saved by a previous pass list their number of records in a manifest
+    manifest = ShardManifest(input_dir)
+    if not os.path.exists(manifest._manifest_path()): return None
+    return sum(shard["records"] for shard in manifest.load().shards.values())
+
+
+def _check_pipeline_arguments(parser, args, saves_output, group_by = None):
+    
+    if args.shard_parallel:
+        if not saves_output: parser.error("--shard_parallel requires saving to an output directory")
+        if group_by is not None: parser.error("--shard_parallel cannot be combined with grouping")
+
+    if args.resume:
+        if not saves_output: parser.error("--resume requires saving to an output directory")
+        if group_by is not None: parser.error("--resume cannot be combined with grouping")
+
+
+def _run_pipeline(args, map_fn, reduce_io, group_by = None, initializer = None, output_dirs = None):
 
-    jsonl_files = glob(os.path.join(args.input_dir, "*.jsonl.gz"))
-    jsonl_files += glob(os.path.join(args.input_dir, "*.jsonl"))
+    jsonl_files = _list_input_files(args.input_dir)
+    total_records = _count_input_records(args.input_dir) if group_by is None else None
+
+    reporter = MetricsReporter(args.metrics_file, args.metrics_interval)
+    map_fn = MeasuredMap(map_fn, trace_rate = args.trace_rate)
+
+    quarantine = None
+    if _has_watchdog(args):
+        quarantine = Quarantine(_quarantine_dir(args, output_dirs), get_codec(args.codec))
+
+    if args.shard_parallel or args.resume:
+        splits = list_input_splits(jsonl_files, split_bytes = args.split_mb * 1e6)
+        tasks  = list(enumerate(splits))
+        checkpoint = None
+
+        if args.resume:
+            checkpoint = Checkpoint(output_dirs).load()
+            tasks = [(split_id, split) for split_id, split in tasks if not checkpoint.is_completed(split)]
+            print("Resume: %d of %d input splits are completed" % (len(splits) - len(tasks), len(splits)))
+            checkpoint.save()
+
+        # Outputs of a resumed split are only completed as a whole. Thus, workers save complete splits.
+        # With the watchdog, outputs are saved by the parent such that killed workers lose no outputs.
+        if not args.shard_parallel and args.parrallel is not None and quarantine is None:
+            print("Resume: input splits are mapped and saved by the worker processes (as with --shard_parallel)")
+            args.shard_parallel = True
+
+        if args.shard_parallel:
+            return _run_shard_parallel(args, map_fn, reduce_io, tasks, reporter,
+                                        checkpoint = checkpoint, initializer = initializer)
+        
+        if len(tasks) < len(splits): total_records = None
+        return _run_checkpointed(args, map_fn, reduce_io, tasks, checkpoint, reporter,
+                                    initializer = initializer, total_records = total_records,
+                                    quarantine = quarantine)
 
     # Load instances as stream
-    instance_stream = iter_jsonl_gz(jsonl_files)
+    instance_stream = iter_jsonl_gz(jsonl_files, get_codec(args.codec))
 
     # Group if necessary
     if group_by is not None:
-        instance_stream = StreamGrouper(group_by, args.group_buffer)(instance_stream)
+        instance_stream = ExternalGrouper(group_by, 
+                                          memory_budget = args.group_memory_mb * 1e6, 
+                                          tmp_dir = args.group_tmp_dir)(instance_stream)
     
     # Map all instances in parallel
-    if not args.parrallel:
+    # If outputs are saved to disk, every worker saves to its own shards.
+    # Workers killed by the watchdog would lose unsaved outputs. Then, outputs are saved by the parent.
+    saves = output_dirs is not None
+    worker_saves = saves and args.parrallel is not None and quarantine is None
+    executor = None
+    if args.parrallel is not None:
+        worker_map_fn = WorkerSaverMap(map_fn, reduce_io) if worker_saves else map_fn
+        executor = _create_executor(args, worker_map_fn, initializer = initializer, quarantine = quarantine)
+        reporter.executor = executor
+
+    if executor is None:
+        if initializer is not None: initializer(args)
         mapped_instance_stream = map(map_fn, instance_stream)
+        reduce_io = reduce_io()
     else:
-        mapped_instance_stream = pmap(map_fn, instance_stream)
+        mapped_instance_stream = executor.map(instance_stream)
+        reduce_io = nullcontext(None) if worker_saves else reduce_io()
 
-    if reduce_fn == jsonl_reduce_io:
-        with reduce_fn(args.output_dir) as saver:
-            for mapped_instances in tqdm(mapped_instance_stream, total=66e6):
+    with reduce_io as reduce_fn:
+        T = tqdm(mapped_instance_stream, total = total_records)
+
+        for mapped_instances in T:
+            if reduce_fn is not None:
                 for mapped_instance in mapped_instances:
                     if mapped_instance is None: continue
-                    saver(mapped_instance)
-    
+                    reduce_fn(mapped_instance)
+
+            reporter.tick()
+
+            if executor is not None and T.n % 1000 == 0:
+                T.set_postfix(queue = executor.queue_depth, batch = executor.tuner.batch_size, refresh = False)
+
+    if executor is not None:
+        executor.stats.report()
+
+    if saves:
+        if executor is None or not worker_saves:
+            shards = reduce_fn.shards
+        else:
+            shards = [shard for worker_shards in executor.close_results for shard in worker_shards]
+        update_shard_manifests(shards)
+
+    if quarantine is not None and quarantine.num_instances > 0:
+        print("Quarantined %d instances in %s" % (quarantine.num_instances, quarantine.quarantine_dir))
+
+    reporter.summary()
+
+
+def mapreduce(map_fn, reduce_fn = jsonl_reduce_io, group_by = None, initializer = None, add_arguments = None):
+    """
+    Maps all instances of the input directory and reduces the outputs.
+
+    If given, the initializer is called with the parsed arguments 
+    once per process before the first instance is mapped.
+    Script specific arguments can be added to the parser with add_arguments.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir")
+
+    if reduce_fn == jsonl_reduce_io:
+        parser.add_argument("output_dir")
+
+    _add_pipeline_arguments(parser)
+    if add_arguments is not None: add_arguments(parser)
+
+    args = parser.parse_args()
+
+    _check_pipeline_arguments(parser, args, reduce_fn == jsonl_reduce_io, group_by)
+
+    output_dirs = None
+    if reduce_fn == jsonl_reduce_io:
+        reduce_io = partial(reduce_fn, args.output_dir, codec = get_codec(args.codec), 
+                                block_size = args.block_kb * 1e3)
+        output_dirs = [args.output_dir]
     else:
-        for mapped_instances in tqdm(mapped_instance_stream, total = 66e6):
-            for mapped_instance in mapped_instances:
-                if mapped_instance is None: continue
-                reduce_fn(mapped_instance)
-    
+        reduce_io = partial(nullcontext, reduce_fn)
+
+    _run_pipeline(args, map_fn, reduce_io, group_by = group_by, 
+                    initializer = initializer, output_dirs = output_dirs)
+
+
+def mapreduce_tee(stages, group_by = None, initializer = None):
+    """
+    Runs a chain of named map functions (e.g. filters) in a single pass.
+
+    The output of each stage is saved to the directory given by --<stage name>.
+    Stages without an output directory are applied but not saved.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir")
+
+    for name, _ in stages:
+        parser.add_argument("--%s" % name, dest = name, 
+                                help = "Output directory for instances passing stage %s" % name)
+
+    _add_pipeline_arguments(parser)
+
+    args = parser.parse_args()
+
+    output_dirs = {name: getattr(args, name) for name, _ in stages 
+                    if getattr(args, name) is not None}
+
+    if len(output_dirs) == 0:
+        parser.error("At least one output directory is required: %s" 
+                        % ", ".join("--%s" % name for name, _ in stages))
+
+    _check_pipeline_arguments(parser, args, True, group_by)
+
+    reduce_io = partial(jsonl_tee_reduce_io, output_dirs, codec = get_codec(args.codec),
+                            block_size = args.block_kb * 1e3)
 
+    _run_pipeline(args, TeeChain(stages), reduce_io, group_by = group_by, 
+                    initializer = initializer, output_dirs = list(output_dirs.values()))
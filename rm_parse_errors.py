@@ -5,9 +5,10 @@ Removes all hunks that contain a parse error.
 """
 
 from mapreduce import mapreduce
+from tssb_miner.edit_encoding import has_parse_error
 
 def remove_error(slc):
-    if "ERROR" in slc["edit_script"]: return []
+    if has_parse_error(slc): return []
 
     return [slc]
 
@@ -1,4 +1,5 @@
 import os
+import re
 
 import argparse
 import math
@@ -8,9 +9,21 @@ import datetime
 
 import traceback
 import subprocess
+import signal
+import socket
+import fcntl
+import threading
 
 import tempfile
+import shutil
 import gzip
+import json
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tssb_miner.work_queue import WorkQueue
+from tssb_miner.mirror_cache import MirrorCache, dir_size
 
 # Different to batch crawl
 # Creates on process per repository
@@ -19,10 +32,58 @@ import gzip
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+def count_entries(output_file):
+    # Crawlers save the number of entries next to their output
+    if os.path.isfile(output_file + ".count"):
+        with open(output_file + ".count", "r") as i:
+            return int(i.read().strip())
+
+    with (gzip.open(output_file, "rb") if is_gzip(output_file) else open(output_file, "rb")) as i:
+        return sum(1 for _ in i)
+
+
+def is_gzip(file_path):
+    with open(file_path, "rb") as i:
+        return i.read(2) == b"\x1f\x8b"
+
+
+# Mode of files created with open() under the umask of the process.
+# Read once since os.umask can only be read by setting it.
+UMASK = os.umask(0)
+os.umask(UMASK)
+DEFAULT_FILE_MODE = 0o666 & ~UMASK
+
+
+def transfer_file(source_path, target_path, compress = False):
+    # Concatenated gzip members form a valid gzip file. Therefore, results are never decoded.
+    if compress and not is_gzip(source_path):
+        with open(source_path, "rb") as i, gzip.open(target_path, "ab") as o:
+            shutil.copyfileobj(i, o)
+        return
+
+    if not os.path.exists(target_path):
+        try:
+            os.rename(source_path, target_path)
+            os.chmod(target_path, DEFAULT_FILE_MODE) # Temporary files are only readable by their owner
+            return
+        except OSError:
+            pass # Different file systems
+
+    with open(source_path, "rb") as i, open(target_path, "ab") as o:
+        shutil.copyfileobj(i, o)
+
+
 class RollingAppender:
+    """
+    Moves crawler results into rolling output files without touching single lines.
+
+    Files are rotated after a complete transfer. Hence, a file
+    can contain slightly more than max_saves entries.
+    """
 
-    def __init__(self, target_dir, compress = False, max_saves = -1):
+    def __init__(self, target_dir, compress = False, max_saves = -1, prefix = "single_commits"):
         self.target_dir = target_dir
+        self.prefix = prefix
         self.max_saves = max_saves
         self.compress = compress
 
@@ -30,54 +91,167 @@ class RollingAppender:
         self.current_saves = 0
         self.num_files = 0
 
+        # Several crawlers might finish at the same time
+        self.lock = threading.Lock()
+
     def _update_file(self, n = 0):
         self.current_saves += n
 
         if (self.current_file_path is None
              or (self.max_saves > 0 and self.current_saves >= self.max_saves)):
             self.num_files += 1
-            self.current_file_path = os.path.join(self.target_dir, "single_commits-%d.jsonl" % self.num_files)
+            self.current_file_path = os.path.join(self.target_dir, "%s-%d.jsonl" % (self.prefix, self.num_files))
+            if self.compress: self.current_file_path += ".gz"
             self.current_saves = 0
         
         return self.current_file_path
 
-    def _open_file(self, file_path):
-        if self.compress:
-            return gzip.open(file_path + ".gz", "a")
-        else:
-            return open(file_path, "ab")
 
+    def append(self, copy_file_path, num_lines = None):
+        if num_lines is None: num_lines = count_entries(copy_file_path)
+        if num_lines == 0: return 0
 
-    def append(self, copy_file_path):
-        with open(copy_file_path, "r") as line_stream:
+        with self.lock:
             file_path = self._update_file()
-            file_io = self._open_file(file_path)
             print("Transfer results to %s" % file_path)
 
-            try:
-                for line in line_stream:
-                    file_io.write(line.encode("utf-8"))
-                    new_path = self._update_file(1)
-                    if file_path != new_path:
-                        file_path = new_path
-                        file_io = self._open_file(file_path)
-                        print("Transfer results to %s" % file_path)
-            finally:
-                file_io.close()
+            transfer_file(copy_file_path, file_path, self.compress)
+            self._update_file(num_lines)
+
+        return num_lines
+
+
+class CrawlState:
+    """
+    Remembers the last crawled HEAD and the crawl status of every repository.
+
+    Repositories whose HEAD did not change since the last completed crawl are skipped.
+    Otherwise, only commits after the last crawled HEAD are crawled.
+    A partial crawl (budget exhausted) is resumed after its last crawled commit.
+
+    Several processes (e.g. pulling from the same work queue) can share a state file.
+    Updates are merged into the current file under an exclusive file lock.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.repos = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.state_file): return {}
+        with open(self.state_file, "r") as i:
+            return json.load(i)
+
+    def last_head(self, repository):
+        # Only set by completed crawls. Results of failed crawls are never saved.
+        return self.repos.get(repository, {}).get("head")
+
+    def resume_point(self, repository):
+        # Commit range and last crawled commit of a partial crawl
+        return self.repos.get(repository, {}).get("partial")
+
+    def last_seconds(self, repository):
+        return self.repos.get(repository, {}).get("seconds")
+
+    def update(self, repository, head, status, num_entries = 0, seconds = None, from_commit = None, resume_after = None):
+        with self.lock, open(self.state_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Other processes might have updated other repositories in the meantime
+            self.repos = self._load()
+
+            repo_state = self.repos.setdefault(repository, {})
+            if status == "completed": 
+                repo_state["head"] = head
+                repo_state.pop("partial", None)
+            if status == "completed" and seconds is not None: repo_state["seconds"] = round(seconds, 2)
+            if status == "partial":
+                repo_state["partial"] = {"from": from_commit, "to": head, "resume_after": resume_after}
+            repo_state["status"]  = status
+            repo_state["entries"] = repo_state.get("entries", 0) + num_entries
+            repo_state["updated"] = datetime.datetime.now().isoformat()
+
+            tmp_file = "%s.%s-%d.tmp" % (self.state_file, socket.gethostname(), os.getpid())
+            with open(tmp_file, "w") as o:
+                json.dump(self.repos, o, indent = 1)
+            os.replace(tmp_file, self.state_file)
 
 
+def remote_head(repository, timeout = 60):
+    try:
+        output = subprocess.run(["git", "ls-remote", repository, "HEAD"], capture_output = True, 
+                                    check = True, timeout = timeout, text = True).stdout
+    except Exception:
+        return None
+    
+    return output.split()[0] if len(output) > 0 else None
+
+
+
+RUNNING_CRAWLERS = set()
+RUNNING_CRAWLERS_LOCK = threading.Lock() # Workers add and discard crawlers while the main thread cleans up
+
+
+def _kill_crawler(process):
+    # Crawlers run in their own session such that git subprocesses are killed too
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def _kill_running_crawlers():
+    with RUNNING_CRAWLERS_LOCK:
+        processes = list(RUNNING_CRAWLERS)
+
+    for process in processes: _kill_crawler(process)
 
-def run_crawler(repository, target_file, lang = "python", crawl_script = "run_repo_crawler.py"):
+
+def crawler_output_files(target_file, lang = "python"):
+    # Same naming as run_repo_crawler.py: one file per language if multiple languages are crawled
+    langs = lang.split(",")
+    if len(langs) == 1: return {lang: target_file}
+    if target_file.endswith(".gz"): return {l: "%s.%s.gz" % (target_file[:-len(".gz")], l) for l in langs}
+    return {l: "%s.%s" % (target_file, l) for l in langs}
+
+
+def run_crawler(repository, target_file, lang = "python", crawl_script = "run_repo_crawler.py", 
+                    timeout = None, from_commit = None, crawl_options = (), to_commit = None, resume_after = None):
     script_path = os.path.join(BASE_DIR, crawl_script)
+    command = ["python", script_path, repository, target_file, "--lang", lang] + list(crawl_options)
+    if from_commit is not None: command += ["--from_commit", from_commit]
+    if to_commit is not None: command += ["--to_commit", to_commit]
+    if resume_after is not None: command += ["--resume_after", resume_after]
+
     try:
-        subprocess.run(["python", script_path, repository, target_file, "--lang", lang], check=True)
+        process = subprocess.Popen(command, start_new_session = True)
+        with RUNNING_CRAWLERS_LOCK:
+            RUNNING_CRAWLERS.add(process)
+        try:
+            return_code = process.wait(timeout = timeout)
+        except subprocess.TimeoutExpired:
+            _kill_crawler(process)
+            print("Timeout: Crawling %s took longer than %d seconds" % (repository, timeout))
+            return False
+        except BaseException as e:
+            _kill_crawler(process)
+            raise e
+        finally:
+            with RUNNING_CRAWLERS_LOCK:
+                RUNNING_CRAWLERS.discard(process)
+
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, process.args)
+
     except KeyboardInterrupt as e:
         raise e
     except Exception:
         traceback.print_exc()
         return False
     
-    return os.path.isfile(target_file)
+    return all(os.path.isfile(output_file) for output_file in crawler_output_files(target_file, lang).values())
 
 
 def chunk_repos(args, repos):
@@ -94,6 +268,344 @@ def chunk_repos(args, repos):
 
 
 
+def crawl_options(args):
+    options = []
+    if args.mirror_dir: options += ["--mirror_dir", args.mirror_dir]
+    if args.mirror_budget_gb: options += ["--mirror_budget_gb", str(args.mirror_budget_gb)]
+
+    for limit in ["max_diff_lines", "max_files_per_commit", "max_seconds", "max_rss_mb"]:
+        if getattr(args, limit) is not None: options += ["--%s" % limit, str(getattr(args, limit))]
+
+    return options
+
+
+SKIP_REPORT_LOCK = threading.Lock()
+
+# Crawlers stop early if one of these budgets is exhausted
+BUDGET_REASONS = {"max_seconds", "max_rss"}
+
+
+def collect_skip_report(args, tmpfile, repository):
+    # Collects the items skipped by a crawler into a single report of the batch
+    report_file = tmpfile + ".skipped"
+    if not os.path.isfile(report_file): return []
+
+    with open(report_file, "r") as i:
+        skipped = [json.loads(line) for line in i]
+
+    if len(skipped) > 0:
+        with SKIP_REPORT_LOCK, open(os.path.join(args.output_dir, "skipped.jsonl"), "a") as o:
+            for entry in skipped:
+                o.write(json.dumps(dict(entry, repository = repository)) + "\n")
+
+    return skipped
+
+
+def crawl_repository(args, savers, repository, index, state = None):
+    # Returns the crawl time and the kind of crawl: full, incremental, partial, unchanged or failed
+    start_time = time.time()
+
+    head, from_commit, resume_after = None, None, None
+    partial = state.resume_point(repository) if state is not None else None
+
+    if partial is not None:
+        # The commit range of a partial crawl is kept until it is crawled completely
+        head, from_commit, resume_after = partial["to"], partial["from"], partial["resume_after"]
+        print("Resume partial crawl of %s after %s" % (repository, resume_after))
+
+    elif state is not None:
+        head = remote_head(repository)
+        from_commit = state.last_head(repository)
+
+        if head is not None and head == from_commit:
+            print("Skip %s: HEAD %s was already crawled" % (repository, head))
+            return time.time() - start_time, "unchanged"
+
+    # With --compress, the crawler compresses its results directly
+    if args.tmpfile:
+        # Concurrent crawlers cannot share a temporary file
+        tmpfile = args.tmpfile if args.workers <= 1 else "%s.%s" % (args.tmpfile, index)
+        if args.compress and not tmpfile.endswith(".gz"): tmpfile += ".gz"
+        desc    = None
+    else:
+        desc, tmpfile = tempfile.mkstemp(suffix = ".jsonl.gz" if args.compress else ".jsonl")
+
+    completed = run_crawler(repository, tmpfile, lang = args.lang, 
+                                crawl_script = args.crawl_script, timeout = args.timeout,
+                                from_commit = from_commit, crawl_options = crawl_options(args),
+                                to_commit = head, resume_after = resume_after)
+
+    output_files = crawler_output_files(tmpfile, args.lang)
+    num_entries  = sum(savers[lang].append(output_file) for lang, output_file in output_files.items()) if completed else 0
+
+    skipped = collect_skip_report(args, tmpfile, repository) if completed else []
+    budget  = next((entry for entry in skipped if entry["reason"] in BUDGET_REASONS), None)
+
+    rewritten = next((entry for entry in skipped if entry["reason"] == "history_rewritten"), None)
+    if rewritten is not None:
+        # The recorded commits are not part of the history anymore. The crawler used another range.
+        print("History of %s was rewritten: Crawled from %s up to %s" % (
+            repository, rewritten["from_commit"] or "the first commit", rewritten["to_commit"]
+        ))
+        head, from_commit, resume_after = rewritten["to_commit"], rewritten["from_commit"], rewritten["resume_after"]
+    if budget is not None: print("Budget exhausted: Crawled %s only partially" % repository)
+
+    if state is not None:
+        # Without a known HEAD, the next run has to crawl everything again
+        status = "completed" if completed and head is not None else "failed"
+        if status == "completed" and budget is not None: 
+            status = "partial"
+            resume_after = budget.get("last_commit") or resume_after # No new commit might have been crawled
+        state.update(repository, head, status, num_entries, time.time() - start_time, 
+                        from_commit = from_commit, resume_after = resume_after)
+
+    if desc: os.close(desc)
+    for output_file in set(output_files.values()) | {tmpfile}:
+        for file_path in (output_file, output_file + ".count", output_file + ".skipped"):
+            if os.path.isfile(file_path): os.remove(file_path)
+
+    if not completed:        crawl = "failed"
+    elif budget is not None: crawl = "partial"
+    elif from_commit is not None or resume_after is not None: crawl = "incremental"
+    else:                    crawl = "full"
+
+    return time.time() - start_time, crawl
+
+
+# Cost estimation ----------------------------------------------------------------
+# Crawl times are estimated from the time of the last crawl, the number of commits
+# (if a mirror exists) or the size of the repository (mirror or hosting API).
+
+DEFAULT_SECONDS_PER_REPO   = 1.0
+DEFAULT_SECONDS_PER_COMMIT = 0.01
+DEFAULT_SECONDS_PER_MB     = 1.0
+
+# Statistic -> (default rate, unit)
+COST_FEATURES = {
+    "commits"   : (DEFAULT_SECONDS_PER_COMMIT, 1),
+    "pack_bytes": (DEFAULT_SECONDS_PER_MB, 1e6),
+}
+
+
+def github_size(repository, timeout = 10):
+    """Size of a GitHub repository in bytes as reported by the GitHub API (None if unknown)."""
+    match = re.match(r"^(?:https?://|git@)github\.com[/:]([^/]+)/([^/]+?)(?:\.git)?/?$", repository.strip())
+    if match is None: return None
+
+    request = urllib.request.Request("https://api.github.com/repos/%s/%s" % match.groups(),
+                                        headers = {"Accept": "application/vnd.github+json"})
+    if os.environ.get("GITHUB_TOKEN"):
+        request.add_header("Authorization", "Bearer %s" % os.environ["GITHUB_TOKEN"])
+
+    with urllib.request.urlopen(request, timeout = timeout) as response:
+        return json.load(response)["size"] * 1024 # Reported in KB
+
+
+def scan_repository(repository, mirror_cache = None, state = None, remote_size = False):
+    """Cheap statistics to estimate the crawl time of a repository (without cloning it)."""
+    stats = {}
+
+    if state is not None and state.last_seconds(repository) is not None:
+        stats["last_seconds"] = state.last_seconds(repository)
+
+    if mirror_cache is not None:
+        mirror_path = mirror_cache.mirror_path(repository)
+        if os.path.isdir(mirror_path):
+            try:
+                stats["commits"] = int(subprocess.run(["git", "rev-list", "--count", "HEAD"], cwd = mirror_path, 
+                                                        capture_output = True, check = True, text = True).stdout)
+            except (subprocess.CalledProcessError, ValueError):
+                pass
+            stats["pack_bytes"] = dir_size(os.path.join(mirror_path, "objects"))
+
+    if remote_size and "pack_bytes" not in stats:
+        # The size reported by the hosting service approximates the size of a mirror
+        pack_bytes = github_size(repository)
+        if pack_bytes is not None: stats["pack_bytes"] = pack_bytes
+
+    return stats
+
+
+def calibrate_cost_model(cost_log, feature = "commits"):
+    """Fits seconds = overhead + feature * rate to the actual times of earlier full crawls."""
+    default_rate, unit = COST_FEATURES[feature]
+    points = []
+
+    if cost_log is not None and os.path.exists(cost_log):
+        with open(cost_log, "r") as i:
+            for line in i:
+                entry = json.loads(line)
+                if feature in entry: points.append((entry[feature] / unit, entry["actual_seconds"]))
+
+    if len(set(x for x, _ in points)) < 2:
+        return DEFAULT_SECONDS_PER_REPO, default_rate / unit
+
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_seconds = sum(seconds for _, seconds in points) / len(points)
+
+    rate = (sum((x - mean_x) * (seconds - mean_seconds) for x, seconds in points)
+             / sum((x - mean_x) ** 2 for x, _ in points))
+    rate = max(rate, 0.0)
+
+    return max(mean_seconds - rate * mean_x, 0.0), rate / unit
+
+
+def estimate_costs(args, repos, state = None):
+    """Estimates the crawl time of every repository in seconds. Returns the estimates and the scanned statistics."""
+    mirror_cache = MirrorCache(args.mirror_dir) if args.mirror_dir else None
+    models = {feature: calibrate_cost_model(args.cost_log, feature) for feature in COST_FEATURES}
+
+    remote_size = args.remote_sizes
+    stats, costs = {}, {}
+    for repository in repos:
+        try:
+            repo_stats = stats[repository] = scan_repository(repository, mirror_cache, state, remote_size)
+        except OSError as e:
+            # e.g. rate limit of the API. Sizes of all other repositories are not requested.
+            print("Cannot request size of %s (%s). Continue without remote sizes." % (repository, e))
+            remote_size = False
+            repo_stats = stats[repository] = scan_repository(repository, mirror_cache, state)
+
+        if "last_seconds" in repo_stats:
+            costs[repository] = repo_stats["last_seconds"]
+            continue
+
+        for feature, (overhead, rate) in models.items(): # Most precise statistic first
+            if feature in repo_stats:
+                costs[repository] = overhead + repo_stats[feature] * rate
+                break
+
+    # Repositories without any statistics are assumed to be typical
+    known = sorted(costs.values())
+    default_cost = known[len(known) // 2] if len(known) > 0 else 1.0
+    for repository in repos: costs.setdefault(repository, default_cost)
+
+    print("Estimated %s of crawl time for %d repos (%d without statistics)" % (
+        str(datetime.timedelta(seconds=int(sum(costs.values())))), len(repos), len(repos) - len(known)
+    ))
+
+    return costs, stats
+
+
+def schedule_repos(args, repos, costs):
+    if args.schedule == "longest_first":
+        # Long crawls start first such that no worker is left with a long crawl at the end
+        return sorted(repos, key = lambda repository: -costs[repository])
+    return repos
+
+
+class CostTracker:
+    """
+    Cost-weighted ETA of a crawl.
+
+    The ETA is the estimated cost of all remaining repositories scaled by the ratio
+    between actual and estimated time of finished repositories. Estimated and actual times
+    are logged to cost_log to calibrate later estimates. Only full crawls are logged
+    since estimates are computed for the full history.
+    """
+
+    def __init__(self, costs, stats = None, workers = 1, cost_log = None):
+        self.costs = costs
+        self.stats = stats or {}
+        self.workers = workers
+        self.cost_log = cost_log
+
+        self.remaining_cost = sum(costs.values())
+        self.finished_cost  = 0.0
+        self.finished_time  = 0.0
+        self.lock = threading.Lock()
+
+    def eta(self):
+        ratio = self.finished_time / self.finished_cost if self.finished_cost > 0 else 1.0
+        return self.remaining_cost * ratio / self.workers
+
+    def finish(self, repository, run_time, crawl = "full"):
+        estimated = self.costs.get(repository, 0.0)
+
+        with self.lock:
+            self.remaining_cost -= estimated
+            self.finished_cost  += estimated
+            self.finished_time  += run_time
+
+            if self.cost_log is not None and crawl == "full":
+                entry = dict(self.stats.get(repository, {}), repository = repository, 
+                                estimated_seconds = round(estimated, 2), actual_seconds = round(run_time, 2))
+                with open(self.cost_log, "a") as o:
+                    o.write(json.dumps(entry) + "\n")
+
+            return self.eta()
+
+
+def eta_str(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def crawl_concurrently(args, savers, repos, state = None, tracker = None):
+
+    with ThreadPoolExecutor(max_workers = args.workers) as pool:
+        futures = {pool.submit(crawl_repository, args, savers, repository, i, state): repository
+                    for i, repository in enumerate(repos)}
+        
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                run_time, crawl = future.result()
+                repository = futures[future]
+                eta = tracker.finish(repository, run_time, crawl)
+
+                print("[%d / %d Est. %s] %s commits from %s (%.1fs, estimated %.1fs)" % (
+                    i + 1, len(repos), eta_str(eta), "Failed to collect" if crawl == "failed" else "Collected",
+                    repository, run_time, tracker.costs[repository]
+                ))
+
+        except KeyboardInterrupt as e:
+            for future in futures: future.cancel()
+            _kill_running_crawlers()
+            raise e
+
+
+def crawl_from_queue(args, savers, queue, state = None, tracker = None):
+    # Every worker pulls the next repository from a queue shared by all nodes
+    stop = threading.Event()
+
+    def work(worker_id):
+        while not stop.is_set():
+            queue.requeue_expired()
+            lease = queue.claim()
+
+            if lease is None:
+                if queue.is_finished(): return
+                time.sleep(args.queue_poll) # Leases of other workers might still expire
+                continue
+
+            completed = False
+            try:
+                run_time, crawl = crawl_repository(args, savers, lease.item, worker_id, state)
+                completed = crawl != "failed"
+            finally:
+                # Interrupted crawls are given back to the queue. Failed crawls are retried.
+                if stop.is_set(): lease.release()
+                elif completed: lease.complete()
+                else: lease.fail(args.max_attempts)
+
+            tracker.finish(lease.item, run_time, crawl)
+
+            counts = queue.counts()
+            print("[%d done, %d running, %d pending] %s commits from %s (%.1fs, estimated %.1fs)" % (
+                counts["done"], counts["leased"], counts["pending"], "Collected" if completed else "Failed to collect",
+                lease.item, run_time, tracker.costs[lease.item]
+            ))
+
+    with ThreadPoolExecutor(max_workers = args.workers) as pool:
+        futures = [pool.submit(work, i) for i in range(args.workers)]
+
+        try:
+            for future in as_completed(futures): future.result()
+        except BaseException as e:
+            stop.set()
+            _kill_running_crawlers()
+            raise e
+
+
 def main(): 
     parser = argparse.ArgumentParser()
 
@@ -103,12 +615,51 @@ def main():
     parser.add_argument("--chunk", type=int, default=-1)
     parser.add_argument("--max_chunks", type=int, default=-1)
     parser.add_argument("--max_items_per_file", type=int, default=-1)
-    parser.add_argument("--lang", default = "python")
+    parser.add_argument("--lang", default = "python",
+                            help="Language or comma separated list of languages (saved to <output_dir>/<lang>)")
     parser.add_argument("--tmpfile")
     parser.add_argument("--compress", action="store_true")
 
     parser.add_argument("--crawl_script", default="run_repo_crawler.py")
 
+    parser.add_argument("--workers", type=int, default=1,
+                            help="Number of repositories crawled at the same time")
+    parser.add_argument("--timeout", type=float,
+                            help="Maximal time in seconds for crawling a single repository")
+
+    parser.add_argument("--max_diff_lines", type=int, 
+                            help="Skip commits that add and delete more lines in a single file")
+    parser.add_argument("--max_files_per_commit", type=int, 
+                            help="Skip commits that modify more files")
+    parser.add_argument("--max_seconds", type=float, 
+                            help="Crawlers stop after the given time and keep their results (unlike --timeout)")
+    parser.add_argument("--max_rss_mb", type=float, 
+                            help="Crawlers stop if they use more memory and keep their results")
+    parser.add_argument("--state_file",
+                            help="JSON file with the last crawled HEAD per repository. Only new commits are crawled if given.")
+    parser.add_argument("--mirror_dir",
+                            help="Cache of mirror clones reused between crawls (shared by all crawlers)")
+    parser.add_argument("--mirror_budget_gb", type=float,
+                            help="Maximal size of the mirror cache. Least recently used mirrors are removed first.")
+
+    parser.add_argument("--queue_dir",
+                            help="Work queue on a shared file system. All processes using the same queue pull repositories from it (replaces --chunk).")
+    parser.add_argument("--lease_timeout", type=float, default=600,
+                            help="Seconds without heartbeat after which a leased repository is queued again")
+    parser.add_argument("--heartbeat", type=float, default=30,
+                            help="Seconds between two heartbeats of a leased repository")
+    parser.add_argument("--queue_poll", type=float, default=10,
+                            help="Seconds to wait for leases of other workers if no repository is pending")
+    parser.add_argument("--max_attempts", type=int, default=3,
+                            help="Failed repositories are queued again until they failed this many times")
+
+    parser.add_argument("--schedule", choices=["index", "longest_first"], default="longest_first",
+                            help="Crawl repositories in index order or with the longest estimated crawl time first")
+    parser.add_argument("--cost_log",
+                            help="JSON lines file with estimated and actual crawl times (used to calibrate the estimates)")
+    parser.add_argument("--remote_sizes", action="store_true",
+                            help="Estimate crawl times of repositories without mirror from their size reported by the GitHub API (uses GITHUB_TOKEN if set)")
+
     args = parser.parse_args()
 
     repos = []
@@ -117,37 +668,63 @@ def main():
         for line in i: 
             repos.append(line[:-1])
 
-    repos = chunk_repos(args, repos)
+    if not args.queue_dir: repos = chunk_repos(args, repos)
+
+    # Processes pulling from the same queue might share an output directory
+    prefix = "single_commits-%s-%d" % (socket.gethostname(), os.getpid()) if args.queue_dir else "single_commits"
+
+    savers = {}
+    langs  = args.lang.split(",")
+    for lang in langs:
+        target_dir = args.output_dir if len(langs) == 1 else os.path.join(args.output_dir, lang)
+        os.makedirs(target_dir, exist_ok = True)
+        savers[lang] = RollingAppender(target_dir, compress=args.compress, max_saves=args.max_items_per_file, 
+                                            prefix=prefix)
+
+    state = CrawlState(args.state_file) if args.state_file else None
+
+    if args.queue_dir:
+        queue = WorkQueue(args.queue_dir, lease_timeout=args.lease_timeout, heartbeat_interval=args.heartbeat)
+        costs_file = os.path.join(args.queue_dir, "costs.json")
+
+        def schedule_queue():
+            # Only processes started before the queue exists scan the repositories. All others read their estimates.
+            costs, stats = estimate_costs(args, repos, state)
+            tmp_file = "%s.%s-%d.tmp" % (costs_file, socket.gethostname(), os.getpid())
+            with open(tmp_file, "w") as o:
+                json.dump({"costs": costs, "stats": stats}, o)
+            os.replace(tmp_file, costs_file) # Saved before the queue exists
+            return schedule_repos(args, repos, costs)
+
+        queue.initialize(schedule_queue)
+        if os.path.exists(costs_file):
+            with open(costs_file, "r") as i:
+                estimates = json.load(i)
+        else:
+            costs, stats = estimate_costs(args, repos, state) # Queue without saved estimates
+            estimates = {"costs": costs, "stats": stats}
 
-    saver = RollingAppender(args.output_dir, compress=args.compress, max_saves=args.max_items_per_file)
+        tracker = CostTracker(estimates["costs"], estimates["stats"], workers = args.workers, cost_log = args.cost_log)
+        print("Process repos from queue %s (%d pending)..." % (args.queue_dir, queue.counts()["pending"]))
+        return crawl_from_queue(args, savers, queue, state, tracker)
 
-    expected_time = 0.0
+    costs, stats = estimate_costs(args, repos, state)
+    tracker = CostTracker(costs, stats, workers = args.workers, cost_log = args.cost_log)
+    repos = schedule_repos(args, repos, costs)
 
     print("Process %d repos..." % len(repos))
 
-    for i, repository in enumerate(repos):
-
-        total_expected_time = (len(repos) - i) * expected_time
-        total_et_str = str(datetime.timedelta(seconds=total_expected_time))
-
-        print("[%d / %d Est. %s] Collect commits from %s" % (i, len(repos), total_et_str, repository))
+    if args.workers > 1:
+        return crawl_concurrently(args, savers, repos, state, tracker)
 
-        start_time = time.time()
-
-        if args.tmpfile:
-            tmpfile = args.tmpfile
-            desc    = None
-        else:
-            desc, tmpfile = tempfile.mkstemp()
-
-        completed = run_crawler(repository, tmpfile, lang = args.lang, crawl_script = args.crawl_script)
+    for i, repository in enumerate(repos):
 
-        if completed: saver.append(tmpfile)
-        if desc: os.close(desc)
-        if os.path.isfile(tmpfile): os.remove(tmpfile)
+        print("[%d / %d Est. %s] Collect commits from %s (estimated %.1fs)" % (
+            i, len(repos), eta_str(tracker.eta()), repository, costs[repository]
+        ))
 
-        run_time = time.time() - start_time
-        expected_time += (run_time - expected_time) / (i + 1)
+        run_time, crawl = crawl_repository(args, savers, repository, i, state)
+        tracker.finish(repository, run_time, crawl)
     
 
 if __name__ == '__main__':
@@ -0,0 +1,29 @@
+"""
+Should run after run_slc_process.py.
+
+Runs rm_parse_errors.py -> rm_nostmt.py -> rm_nobug.py -> rm_comodified.py
+in a single pass. Instances are read and decoded only once and the result of 
+each stage is saved into its own output directory.
+
+Produces: SSC-28M (--ssc), SSB-9M (--ssb), TSSB-3M (--tssb)
+
+"""
+
+from mapreduce import mapreduce_tee
+
+from rm_parse_errors import remove_error
+from rm_nostmt import filter_nostmt
+from rm_nobug import filter_nobug
+from rm_comodified import filter_comod
+
+
+STAGES = [
+    ("parsable", remove_error),
+    ("ssc",      filter_nostmt),
+    ("ssb",      filter_nobug),
+    ("tssb",     filter_comod),
+]
+
+
+if __name__ == '__main__':
+    mapreduce_tee(STAGES)
@@ -1,16 +1,24 @@
+import os
+import time
 import argparse
 import json
+import gzip
+import subprocess
+import tempfile
 
 from tqdm import tqdm
 from collections import namedtuple
 from collections import OrderedDict
+from contextlib import ExitStack
 from pydriller import Repository, ModificationType
 
 from code_diff.diff_utils import parse_hunks
 
-from tssb_miner.diff_utils import iter_stmts
+from tssb_miner.tokenizers import iter_stmts
 from tssb_miner.diff_utils import has_diff, diff_tokens
 from tssb_miner.tokenizers import tokenize
+from tssb_miner.mirror_cache import MirrorCache, repo_name, run_git
+from tssb_miner.git_log import iter_log_commits
 
 LANG_EXTENSIONS = {
     "python": [".py"],
@@ -20,6 +28,34 @@ LANG_EXTENSIONS = {
 
 SingleLineCommit = namedtuple("SingleLineCommit", ["project_url", "commit", "modfile", "lang"])
 
+
+def parse_langs(lang):
+    # A single language, a comma separated string or a list of languages
+    return lang.split(",") if isinstance(lang, str) else list(lang)
+
+
+def lang_extensions(langs):
+    return [ext for lang in langs for ext in LANG_EXTENSIONS[lang]]
+
+
+def file_lang(filename, langs):
+    for lang in langs:
+        if any(filename.endswith(ext) for ext in LANG_EXTENSIONS[lang]): return lang
+    return None
+
+
+def lang_output_file(output_file, lang, langs):
+    # Every language is saved to its own file if multiple languages are crawled
+    if len(langs) == 1: return output_file
+    if output_file.endswith(".gz"): return "%s.%s.gz" % (output_file[:-len(".gz")], lang)
+    return "%s.%s" % (output_file, lang)
+
+
+def open_output(output_file):
+    # Output files ending with .gz are compressed while crawling
+    if output_file.endswith(".gz"): return gzip.open(output_file, "wt")
+    return open(output_file, "w")
+
 # Identify single line commits --------------------------------
 
 
@@ -71,7 +107,7 @@ def is_single_token_mod(diff, lang):
     if len(hunks) != 1: return False
     
     hunk = hunks[0]
-    new_lines, old_lines = list(iter_stmts(hunk.after)), list(iter_stmts(hunk.before))
+    new_lines, old_lines = list(iter_stmts(hunk.after, lang)), list(iter_stmts(hunk.before, lang))
     
     if len(new_lines) != len(old_lines): return False
     if len(new_lines) == 0: return False
@@ -93,7 +129,7 @@ def single_token_mod(diff, lang):
     single_diff = None
 
     for hunk in hunks:
-        new_lines, old_lines = list(iter_stmts(hunk.after)), list(iter_stmts(hunk.before))
+        new_lines, old_lines = list(iter_stmts(hunk.after, lang)), list(iter_stmts(hunk.before, lang))
         
         if len(new_lines) != len(old_lines): return "None"
         if len(new_lines) == 0: return "None"
@@ -140,31 +176,304 @@ def create_result_entry(commit, modfile, lang = "python"):
 
 
 
-def parse_commit(commit, lang = "python"):
+def parse_commit(commit, lang = "python", candidate_paths = None, limits = None):
+    # Yields single line modifications together with the language of the modified file
+    langs = parse_langs(lang)
     
     for modfile in commit.modified_files:
         
         # Heuristics to exclude mod files
         if modfile.change_type != ModificationType.MODIFY: continue
-        if not any(modfile.filename.endswith(ext) for ext in LANG_EXTENSIONS[lang]): continue
-        if not is_single_line(modfile.diff_parsed, lang): continue
+        modfile_lang = file_lang(modfile.filename, langs)
+        if modfile_lang is None: continue
+        if candidate_paths is not None and modfile.new_path not in candidate_paths: continue
+        if limits is not None and limits.exhausted(commit): return
+        if not is_single_line(modfile.diff_parsed, modfile_lang): continue
 
-        yield modfile
+        yield modfile, modfile_lang
         
 
-def crawl_single_line_commits(repo_url, lang = "python"):
-    repo = Repository(repo_url, only_modifications_with_file_types=LANG_EXTENSIONS[lang])
-
-    T = tqdm(repo.traverse_commits())
+def crawl_single_line_commits(repo_url, lang = "python", from_commit = None, mirror_cache = None, 
+                                prefilter = True, engine = "pydriller", limits = None, 
+                                to_commit = None, resume_after = None):
+    # If from_commit is given, only commits after from_commit are crawled (up to to_commit or HEAD).
+    # If multiple languages are given, all are crawled in a single traversal.
+    # If limits are given, oversized commits are skipped and the crawl stops when the budget is exhausted.
+    # If resume_after is given, all commits up to resume_after (crawled by a partial crawl) are skipped.
+    crawl_args = (parse_langs(lang), from_commit, prefilter, engine, limits, to_commit, resume_after)
+
+    if mirror_cache is not None:
+        with mirror_cache.open(repo_url) as mirror_path:
+            yield from _crawl_single_line_commits(repo_url, mirror_path, *crawl_args)
+
+    elif (prefilter or engine == "gitlog" or (limits is not None and limits.needs_numstat())
+            or from_commit is not None or to_commit is not None) and not os.path.isdir(repo_url):
+        # The prefilter, the limits, the git log engine and the check of the commit range need a local clone
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            clone_path = os.path.join(tmp_dir, repo_name(repo_url))
+            run_git("clone", "--bare", "--quiet", repo_url, clone_path)
+            yield from _crawl_single_line_commits(repo_url, clone_path, *crawl_args)
+
+    else:
+        yield from _crawl_single_line_commits(repo_url, repo_url, *crawl_args)
+
+
+def _traverse_commits(repo_path, langs, from_commit, to_commit, candidates, engine):
+    # Both engines visit commits from oldest to newest
+
+    if engine == "gitlog":
+        if candidates is None: return iter_log_commits(repo_path, from_commit = from_commit, to_commit = to_commit)
+        return iter_log_commits(repo_path, commits = list(reversed(candidates.keys()))) # Candidates are newest first
+
+    if candidates is None:
+        repo = Repository(repo_path, only_modifications_with_file_types=lang_extensions(langs),
+                            from_commit = from_commit, to_commit = to_commit)
+    else:
+        repo = Repository(repo_path, only_commits = list(candidates.keys()), 
+                            from_commit = from_commit, to_commit = to_commit)
+
+    return repo.traverse_commits()
+
+
+def _crawl_single_line_commits(repo_url, repo_path, langs = ("python",), from_commit = None, 
+                                prefilter = False, engine = "pydriller", limits = None,
+                                to_commit = None, resume_after = None):
+
+    # Recorded commits might not exist anymore (e.g. after a force push)
+    crawl_range = checked_range(repo_path, from_commit, to_commit, resume_after)
+    if crawl_range != (from_commit, to_commit, resume_after) and limits is not None:
+        # Reported such that the batch crawler records the range that was actually crawled
+        end = _git_output(repo_path, "rev-parse", crawl_range[1] or "HEAD").strip()
+        limits.skip("history_rewritten", from_commit).update(from_commit = crawl_range[0], to_commit = end, 
+                                                              resume_after = crawl_range[2])
+    from_commit, to_commit, resume_after = crawl_range
+
+    # Oversized commits are found by their numstat before any diff is built
+    numstat, oversized = None, set()
+    if limits is not None and limits.needs_numstat():
+        numstat   = numstat_log(repo_path, rev_range(from_commit, to_commit))
+        oversized = limits.oversized_commits(numstat)
+
+    candidates = None
+    if prefilter:
+        candidates = numstat_candidates(repo_path, langs, from_commit, to_commit, numstat)
+        for commit_hash in oversized: candidates.pop(commit_hash, None)
+        if len(candidates) == 0: return
+
+    T = tqdm(_traverse_commits(repo_path, langs, from_commit, to_commit, candidates, engine))
+    resumed = resume_after is None
 
     for commit in T:
 
+        if not resumed:
+            # Crawled by the previous partial crawl
+            resumed = commit.hash == resume_after
+            continue
+
+        if limits is not None and limits.exhausted(commit): break
+
         # Filter to exclude commits
+        if commit.hash in oversized: continue
+        if commit.hash == from_commit: continue # Crawled in a previous run
         if commit.merge: continue
         if len(commit.parents) != 1: continue
 
-        for single_line_mod in parse_commit(commit, lang):
+        candidate_paths = candidates[commit.hash] if candidates is not None else None
+
+        # Results of a commit are only kept if the budget lasts for the complete commit.
+        # Then, a partial crawl can be resumed after the last crawled commit.
+        single_line_mods = list(parse_commit(commit, langs, candidate_paths, limits))
+        if limits is not None:
+            if limits.stopped: break
+            limits.last_commit = commit.hash
+
+        for single_line_mod, lang in single_line_mods:
             yield SingleLineCommit(repo_url, commit, single_line_mod, lang)
+
+
+# Resource limits ----------------------------------------------------------------
+
+def current_rss():
+    # Resident memory in bytes (Linux only)
+    try:
+        with open("/proc/self/statm", "r") as i:
+            return int(i.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class CrawlLimits:
+    """
+    Resource limits for crawling a single repository.
+
+    Commits with a large diff or many modified files are skipped. Both are decided from
+    the numstat of the commit before its diff is built. If the time or memory budget is exhausted, 
+    the crawl stops early and keeps the results of all completely crawled commits. 
+    Every skipped item is recorded together with the last crawled commit.
+    """
+
+    def __init__(self, max_diff_lines = None, max_files = None, max_seconds = None, max_rss_bytes = None):
+        self.max_diff_lines = max_diff_lines
+        self.max_files      = max_files
+        self.max_seconds    = max_seconds
+        self.max_rss_bytes  = max_rss_bytes
+
+        self.start_time = time.time()
+        self.skipped = []
+        self.stopped = False
+        self.last_commit = None # Last commit that was crawled completely
+
+    def skip(self, reason, commit_hash, path = None, size = None):
+        entry = {"reason": reason, "commit_sha": commit_hash}
+        if path is not None: entry["file_path"] = path
+        if size is not None: entry["size"] = size
+        self.skipped.append(entry)
+        return entry
+
+    def needs_numstat(self):
+        return self.max_diff_lines is not None or self.max_files is not None
+
+    def oversized_commits(self, numstat):
+        # A single large file makes every diff of the commit expensive. Therefore, the whole commit is skipped.
+        oversized = set()
+
+        for commit_hash, files in numstat.items():
+            if self.max_files is not None and len(files) > self.max_files:
+                self.skip("max_files", commit_hash, size = len(files))
+                oversized.add(commit_hash)
+                continue
+
+            if self.max_diff_lines is None: continue
+            for added, deleted, path in files:
+                if added is None or added + deleted <= self.max_diff_lines: continue
+                self.skip("max_diff_lines", commit_hash, path, added + deleted)
+                oversized.add(commit_hash)
+                break
+
+        return oversized
+
+    def exhausted(self, commit):
+        # Checked before every commit and modified file. The commit is the first one that is not crawled completely.
+        if self.stopped: return True
+
+        reason, size = None, None
+        if self.max_seconds is not None and time.time() - self.start_time > self.max_seconds:
+            reason, size = "max_seconds", round(time.time() - self.start_time, 2)
+
+        elif self.max_rss_bytes is not None:
+            rss = current_rss()
+            if rss > self.max_rss_bytes: reason, size = "max_rss", rss
+
+        if reason is None: return False
+
+        self.skip(reason, commit.hash, size = size)["last_commit"] = self.last_commit
+        self.stopped = True
+        return True
+
+    def save_report(self, report_file):
+        with open(report_file, "w") as o:
+            for entry in self.skipped:
+                o.write(json.dumps(entry) + "\n")
+
+
+# Numstat prefilter --------------------------------
+# A single line modification changes at least one line of a file.
+# Therefore, the file has at least one added and one deleted line.
+# Line counts are computed by git without materializing any diff text.
+
+def _git_output(repo_path, *args):
+    return subprocess.run(["git", "-c", "core.quotePath=false"] + list(args), cwd = repo_path, 
+                            check = True, capture_output = True).stdout.decode("utf-8", "ignore")
+
+
+def rev_range(from_commit = None, to_commit = None):
+    to_commit = to_commit if to_commit is not None else "HEAD"
+    return ["%s..%s" % (from_commit, to_commit)] if from_commit is not None else [to_commit]
+
+
+def _git_succeeds(repo_path, *args):
+    return subprocess.run(["git"] + list(args), cwd = repo_path, capture_output = True).returncode == 0
+
+
+def commit_exists(repo_path, commit_hash):
+    return _git_succeeds(repo_path, "cat-file", "-e", "%s^{commit}" % commit_hash)
+
+
+def is_ancestor(repo_path, ancestor, commit_hash):
+    return _git_succeeds(repo_path, "merge-base", "--is-ancestor", ancestor, commit_hash)
+
+
+def checked_range(repo_path, from_commit = None, to_commit = None, resume_after = None):
+    """
+    Drops commits of a range that are not part of the current history.
+
+    If from_commit was rewritten, all commits up to to_commit are crawled.
+    If to_commit was rewritten, the range ends at HEAD and a partial crawl cannot be resumed.
+    """
+
+    if to_commit is not None and not commit_exists(repo_path, to_commit):
+        print("Commit %s does not exist anymore. Crawl up to HEAD." % to_commit)
+        to_commit, resume_after = None, None
+
+    end = to_commit if to_commit is not None else "HEAD"
+
+    if from_commit is not None and not (commit_exists(repo_path, from_commit) and is_ancestor(repo_path, from_commit, end)):
+        print("Commit %s is not an ancestor of %s anymore (history rewritten?). Crawl the full history." % (from_commit, end))
+        from_commit = None
+
+    if resume_after is not None and not (commit_exists(repo_path, resume_after) and is_ancestor(repo_path, resume_after, end)):
+        print("Cannot resume after %s. Crawl the full range." % resume_after)
+        resume_after = None
+
+    return from_commit, to_commit, resume_after
+
+
+def numstat_log(repo_path, revisions, extensions = None):
+    """Returns the line counts of all modified files per commit (commit hash -> [(added, deleted, path)])."""
+
+    pathspec = ["--"] + ["*%s" % ext for ext in extensions] if extensions is not None else []
+    numstat  = _git_output(repo_path, "log", "--numstat", "--no-renames", "--format=%x00%H", *revisions, *pathspec)
+
+    commits, files = {}, None
+    for line in numstat.splitlines():
+        if line.startswith("\0"):
+            files = commits[line[1:]] = []
+            continue
+        if len(line) == 0: continue
+
+        added, deleted, path = line.split("\t", 2)
+        if path.startswith('"'): path = path[1:-1]
+        if added == "-": files.append((None, None, path)) # Binary
+        else:            files.append((int(added), int(deleted), path))
+
+    return commits
+
+
+def numstat_candidates(repo_path, lang = "python", from_commit = None, to_commit = None, numstat = None):
+    """
+    Returns all commits with candidate files for single line modifications (commit hash -> file paths).
+
+    An existing numstat of all files (see numstat_log) is reused if given.
+    """
+
+    extensions = lang_extensions(parse_langs(lang))
+    revisions  = rev_range(from_commit, to_commit)
+    if numstat is None: numstat = numstat_log(repo_path, revisions, extensions)
+
+    candidates = {}
+    for commit_hash, files in numstat.items():
+        for added, deleted, path in files:
+            if added is None or added == 0 or deleted == 0: continue # Binary or only added / deleted
+            if not any(path.endswith(ext) for ext in extensions): continue
+
+            candidates.setdefault(commit_hash, set()).add(path)
+
+    num_commits = int(_git_output(repo_path, "rev-list", "--count", *revisions).strip())
+    print("Prefilter: Pruned %d of %d commits (%d candidate files remain)" % (
+        num_commits - len(candidates), num_commits, sum(len(paths) for paths in candidates.values())
+    ))
+
+    return candidates
             
 
 
@@ -174,16 +483,61 @@ def main():
     parser.add_argument("repo_url")
     parser.add_argument("output_file")
 
-    parser.add_argument("--lang", default="python")
+    parser.add_argument("--lang", default="python", 
+                            help="Language or comma separated list of languages (saved to <output_file>.<lang>)")
+    parser.add_argument("--from_commit", help="Only crawl commits after the given commit")
+    parser.add_argument("--to_commit", help="Only crawl commits up to the given commit (default: HEAD)")
+    parser.add_argument("--resume_after", 
+                            help="Skip all commits up to the given commit (the last commit of a partial crawl with the same range)")
+
+    parser.add_argument("--mirror_dir", help="Cache of mirror clones reused between crawls")
+    parser.add_argument("--mirror_budget_gb", type=float, help="Maximal size of the mirror cache")
+
+    parser.add_argument("--no_prefilter", action="store_true", 
+                            help="Do not prune commits by their numstat before computing diffs")
+    parser.add_argument("--engine", choices=["pydriller", "gitlog"], default="pydriller",
+                            help="Traverse commits with PyDriller or a single streamed git log")
+
+    parser.add_argument("--max_diff_lines", type=int, help="Skip commits that add and delete more lines in a single file")
+    parser.add_argument("--max_files_per_commit", type=int, help="Skip commits that modify more files")
+    parser.add_argument("--max_seconds", type=float, help="Stop crawling the repository after the given time")
+    parser.add_argument("--max_rss_mb", type=float, help="Stop crawling the repository if the crawler uses more memory")
 
     args = parser.parse_args()
 
-    with open(args.output_file, "w") as o:
-        for slc in crawl_single_line_commits(args.repo_url, args.lang):
+    mirror_cache = None
+    if args.mirror_dir:
+        max_bytes = args.mirror_budget_gb * 1e9 if args.mirror_budget_gb else None
+        mirror_cache = MirrorCache(args.mirror_dir, max_bytes = max_bytes)
+
+    limits = CrawlLimits(
+        max_diff_lines = args.max_diff_lines, max_files = args.max_files_per_commit,
+        max_seconds = args.max_seconds, max_rss_bytes = args.max_rss_mb * 1e6 if args.max_rss_mb else None
+    )
+
+    langs = parse_langs(args.lang)
+    output_files = {lang: lang_output_file(args.output_file, lang, langs) for lang in langs}
+    counts = {lang: 0 for lang in langs}
+
+    with ExitStack() as stack:
+        outputs = {lang: stack.enter_context(open_output(output_file)) for lang, output_file in output_files.items()}
+
+        for slc in crawl_single_line_commits(args.repo_url, langs, args.from_commit, mirror_cache, 
+                                                not args.no_prefilter, args.engine, limits,
+                                                args.to_commit, args.resume_after):
             slc_info = create_result_entry(slc.commit, slc.modfile, slc.lang)
             if slc_info is None: continue # We reject a single code change because an AST analysis found an incompatible type
             slc_info["project_url"] = slc.project_url
-            o.write(json.dumps(slc_info) + "\n")
+            outputs[slc.lang].write(json.dumps(slc_info) + "\n")
+            counts[slc.lang] += 1
+
+    # Skipped files and commits are reported per repository
+    limits.save_report(args.output_file + ".skipped")
+
+    # The number of entries is saved next to each output such that it is never read again for counting
+    for lang, output_file in output_files.items():
+        with open(output_file + ".count", "w") as o:
+            o.write("%d\n" % counts[lang])
 
 
 # Helpers ----------------------------------------------------------------
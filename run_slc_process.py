@@ -7,14 +7,21 @@ This script preprocesses all entries.
 
 """
 
-from mapreduce import mapreduce
+from mapreduce import mapreduce, METRICS, TRACER
 
 import code_diff as cd
 from code_diff.diff_utils import parse_hunks, clean_hunk
 from code_diff.gumtree    import json_serialize
 
+from tssb_miner.diff_cache import DiffCache, package_version
+from tssb_miner.edit_encoding import encode_edit_script, derived_edit_fields
+
+import json
+
 import logging as logger
-logger.basicConfig(filename='run_slc.log', filemode='w', encoding='utf-8', level=logger.DEBUG)
+
+DIFF_CACHE = None
+COMPACT_EDITS = False
 
 
 def create_output(slc, hunk, **kwargs):  
@@ -41,18 +48,9 @@ def create_output(slc, hunk, **kwargs):
     return output
 
 
-def _increase_ast_size(diff, current_level):
+# Hunk processing ----------------------------------------------------------------
 
-    if current_level == 0:
-        try:
-            return diff.statement_diff()
-        except Exception:
-            return diff
-        
-    if current_level == 1:
-        return diff.root_diff()
-
-    if current_level > 1: return diff
+EDIT_LEVELS = ["diff", "statement", "root"]
 
 
 def _is_ghost_script(script):
@@ -62,77 +60,163 @@ def _is_ghost_script(script):
     return hasattr(script[0].target_node, "node_id")
 
 
-def compute_edit_script_it(diff):
-    # For efficiency, we donnot compute the edit script for the full AST
-    # While this works in most cases, there exists some corner cases where it fails.
-    # However, we can detect when computation fails: 
-    # ghost nodes (i.e. nodes that do not appear in AST)
-    # appear in the edit script.
-    # If this is the case, we increase the AST context and recompute the edit script
+def _edit_roots(diff):
+    # The AST nodes ASTDiff.edit_script starts from.
+    # Diffs of different levels often share them (e.g. if the diff is already a statement).
+    source_ast, target_ast = diff.source_ast, diff.target_ast
 
-    edit_script = None
-    diff_level  = 0
+    if source_ast.type == target_ast.type and len(source_ast.children) == 0 and len(target_ast.children) == 0:
+        return (source_ast, target_ast)
 
-    while diff_level < 3:
-        edit_script = diff.edit_script()
+    while source_ast.type != target_ast.type:
+        if source_ast.parent is None or target_ast.parent is None: break
+        source_ast, target_ast = source_ast.parent, target_ast.parent
 
-        if not _is_ghost_script(edit_script): return edit_script
-        
-        diff = _increase_ast_size(diff, diff_level)
-        diff_level += 1
+    return (source_ast, target_ast)
 
-    return edit_script # Return most precise edit script (even if it has ghost nodes)
 
+class HunkProcessor:
+    """
+    Computes the SStuB pattern, the edit script and the changed statements of a hunk.
 
+    The hunk is parsed once, and every diff level and edit script is computed at most once.
+    """
 
-def process_hunk(slc, hunk):
+    def __init__(self, hunk, lang = "python"):
+        self.diff = cd.difference(hunk.before, hunk.after, lang = lang)
+        self.edit_level = None
+
+        self._diffs = {0: self.diff}
+        self._edit_scripts = {}
+
+    def level_diff(self, level):
+        if level not in self._diffs:
+            if level == 1: self._diffs[1] = self.statement_diff() or self.diff
+            if level == 2: self._diffs[2] = self.diff.root_diff()
+        return self._diffs[level]
+
+    def statement_diff(self):
+        # None if the diff is not enclosed in a statement
+        if "statement" not in self._diffs:
+            try:
+                self._diffs["statement"] = self.diff.statement_diff()
+            except Exception:
+                self._diffs["statement"] = None
+        return self._diffs["statement"]
+
+    def sstub_pattern(self):
+        return self.diff.sstub_pattern()
+
+    def _edit_script(self, diff):
+        roots = _edit_roots(diff)
+        if roots not in self._edit_scripts:
+            self._edit_scripts[roots] = diff.edit_script()
+        return self._edit_scripts[roots]
+
+    def edit_script(self):
+        # For efficiency, we donnot compute the edit script for the full AST
+        # While this works in most cases, there exists some corner cases where it fails.
+        # However, we can detect when computation fails: 
+        # ghost nodes (i.e. nodes that do not appear in AST)
+        # appear in the edit script.
+        # If this is the case, we increase the AST context (statement, then root) and recompute the edit script
+
+        for level in range(len(EDIT_LEVELS)):
+            edit_script = self._edit_script(self.level_diff(level))
+            self.edit_level = level
+            if not _is_ghost_script(edit_script): break
+
+        return edit_script # Most precise edit script (even if it has ghost nodes)
+
+    def changed_text(self):
+        diff = self.statement_diff() or self.diff
+        return diff.source_text, diff.target_text
+
+
+def compute_diff(slc, hunk):
+    # Returns all results of code_diff for the hunk (or None if the hunk cannot be parsed)
 
-    if len(str(hunk)) > 10_000: # Typically hunks are much smaller than this.
-        logger.debug("Skip hunk in %s [%s] because it is too large" % (slc["project"], slc["commit_sha"]))
-        return None
-    
     # Generate diff
-    logger.debug("Compute diff for hunk in %s [%s]" % (slc["project"], slc["commit_sha"]))
     try:
-        diff = cd.difference(hunk.before, hunk.after, lang = "python")
+        with TRACER.span("diff"):
+            processor = HunkProcessor(hunk, lang = "python")
     except Exception:
-        logger.debug("Skip hunk in %s [%s]" % (slc["project"], slc["commit_sha"]))
+        METRICS.count("hunks_unparsable")
         return None
     
     # Process diff
-    logger.debug("SStub pattern for hunk in %s [%s]" % (slc["project"], slc["commit_sha"]))
-    sstub_pattern = diff.sstub_pattern()
+    with TRACER.span("sstub"):
+        sstub_pattern = processor.sstub_pattern()
+
+    with TRACER.span("edit_script"):
+        edit_script = processor.edit_script()
+        before_diff, after_diff = processor.changed_text()
+
+    with TRACER.span("serialize"):
+        edit_script_json = json_serialize(edit_script)
+
+    return {
+        "before": before_diff,
+        "after" : after_diff,
+        "sstub_pattern": sstub_pattern.name,
+        "edit_script"  : edit_script_json,
+        "edit_level"   : EDIT_LEVELS[processor.edit_level]
+    }
 
-    logger.debug("Edit script for hunk in %s [%s]" % (slc["project"], slc["commit_sha"]))
-    edit_script = compute_edit_script_it(diff)
 
-    try:
-        stmt_diff = diff.statement_diff()
-        before_diff = stmt_diff.source_text
-        after_diff  = stmt_diff.target_text
-    except ValueError:
-        before_diff = diff.source_text
-        after_diff  = diff.target_text
+def cached_compute_diff(slc, hunk):
+    # Duplicate hunks are common. Therefore, results are cached across runs and workers.
+    if DIFF_CACHE is None: return compute_diff(slc, hunk)
 
-    edit_script_json = json_serialize(edit_script)
+    before, after = hunk.before, hunk.after
 
-    logger.debug("Return output for hunk in %s [%s]" % (slc["project"], slc["commit_sha"]))
-    return create_output(slc, hunk,
-                            before = before_diff,
-                            after  = after_diff,
-                            sstub_pattern = sstub_pattern.name,
-                            edit_script   = edit_script_json)
+    with TRACER.span("cache"):
+        result = DIFF_CACHE.get(before, after)
+    if result is not DiffCache.MISSING:
+        METRICS.count("diff_cache_hits")
+        if result is None: METRICS.count("hunks_unparsable")
+        return result
+
+    METRICS.count("diff_cache_misses")
+    result = compute_diff(slc, hunk)
+    with TRACER.span("cache"):
+        DIFF_CACHE.put(before, after, result)
+    return result
+
+
+def compact_result(result):
+    # Saves the edit script as JSON object together with fields derived from it
+    edit_script_json = result["edit_script"]
+    edit_script = json.loads(edit_script_json)
+
+    result = {key: value for key, value in result.items() if key != "edit_script"}
+    result["compact_edit_script"] = encode_edit_script(edit_script)
+    result.update(derived_edit_fields(edit_script, edit_script_json))
+    return result
+
+
+def process_hunk(slc, hunk):
+
+    if len(str(hunk)) > 10_000: # Typically hunks are much smaller than this.
+        METRICS.count("hunks_too_large")
+        return None
+    
+    result = cached_compute_diff(slc, hunk)
+    if result is None: return None
+
+    with TRACER.span("output"):
+        if COMPACT_EDITS: result = compact_result(result)
+        return create_output(slc, hunk, **result)
 
 
 def process_slc(slc):
-    logger.debug("Parse hunks for %s [%s]" % (slc["project_url"], slc["commit_sha"]))
     
     diff_message = slc["diff"]
-    diff_hunks   = parse_hunks(diff_message)
+    with TRACER.span("parse"):
+        diff_hunks = [clean_hunk(hunk) for hunk in parse_hunks(diff_message)]
 
     outputs = []
     for hunk in diff_hunks:
-        hunk = clean_hunk(hunk)
         output = process_hunk(slc, hunk)
         if output is not None: outputs.append(output)
         
@@ -146,5 +230,33 @@ def try_process_slc(slc):
         return []
 
 
+def warmup_worker(args):
+    global DIFF_CACHE, COMPACT_EDITS
+    COMPACT_EDITS = args.compact_edits
+
+    if args.diff_cache:
+        DIFF_CACHE = DiffCache(args.diff_cache, namespace = "code_diff=%s;lang=python;edit_level" % package_version("code_diff"))
+
+    # Loading the tree-sitter parser is expensive.
+    # Therefore, we load it once per worker before the first task arrives.
+    try:
+        cd.difference("x = 0", "x = 1", lang = "python")
+    except Exception:
+        logger.warning("Could not warm up the Python parser")
+
+
+def add_process_arguments(parser):
+    parser.add_argument("--diff_cache", help="sqlite database caching code_diff results across runs (e.g. diff_cache.db)")
+    parser.add_argument("--compact_edits", action="store_true",
+                            help="Save edit scripts in compact encoding with edit_count, parse_error and edit_pattern")
+
+
+def print_cache_summary():
+    hits, misses = METRICS.counts.get("diff_cache_hits", 0), METRICS.counts.get("diff_cache_misses", 0)
+    if hits + misses == 0: return
+    print("Diff cache:      \t%d hits | %d misses | %.1f%% hit rate" % (hits, misses, 100 * hits / (hits + misses)))
+
+
 if __name__ == '__main__':
-    mapreduce(try_process_slc)
\ No newline at end of file
+    mapreduce(try_process_slc, initializer = warmup_worker, add_arguments = add_process_arguments)
+    print_cache_summary()
\ No newline at end of file
@@ -6,10 +6,9 @@ Computes central statistics of the dataset such as SStuB or AST Edit distributio
 
 from mapreduce import mapreduce
 
-import json
 from collections import defaultdict
 
-from tssb_miner.edit_abstraction import abstract_edit_script
+from tssb_miner.edit_encoding import edit_count, edit_pattern
 
 
 def label_instance(slc):
@@ -24,8 +23,7 @@ def label_instance(slc):
     if slc["sstub_pattern"] not in ["SINGLE_TOKEN", "SINGLE_STMT", "NO_STMT", "MULTI_STMT", "CHANGE_STRING_LITERAL"]:
         labels.append("SSTUB")
 
-    edit_script = json.loads(slc["edit_script"])
-    if len(edit_script) == 1:
+    if edit_count(slc) == 1:
         labels.append("SINGLE_EDIT")
 
     return [(slc, labels)]
@@ -84,9 +82,7 @@ class EditCounter:
         self.edit_categories = defaultdict(int)
 
     def __call__(self, slc):
-        edit_script = json.loads(slc["edit_script"])
-
-        abstract_ops = set(abstract_edit_script(edit_script))
+        abstract_ops = set(tuple(op.split("_", 1)) for op in edit_pattern(slc))
         abstract_categories = set(k for k, _ in abstract_ops)
 
         for op_type, op_ctx in abstract_ops:
@@ -0,0 +1,20 @@
+from tssb_miner.tokenizers import iter_stmts, tokenize
+
+
+def test_java_for_header_is_single_statement():
+    text = "for (int i = 0; i < n; i++) {\n    sum += a[i];\n}\n"
+
+    assert list(iter_stmts(text, "java")) == ["for (int i = 0; i < n; i++) ", "    sum += a[i]"]
+
+
+def test_java_block_comment_spans_lines():
+    text = "/* first line\n   second line; with semicolon */\nint x = 1;\n"
+
+    assert list(iter_stmts(text, "java")) == ["/* first line\n   second line; with semicolon */", "int x = 1"]
+    assert list(tokenize(text, "java"))[0] == ("/* first line\n   second line; with semicolon */", "COMMENT")
+
+
+def test_javascript_strings_are_not_split():
+    text = "const s = \"a;b{c}\"; // done; really\nx++;"
+
+    assert list(iter_stmts(text, "javascript")) == ["const s = \"a;b{c}\"", " // done; really", "x++"]
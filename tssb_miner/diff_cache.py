@@ -0,0 +1,68 @@
+import os
+import json
+import sqlite3
+import hashlib
+
+
+def package_version(name):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return "unknown"
+
+
+# Diff cache ----------------------------------------------------------------
+
+class DiffCache:
+    """
+    Persistent content-addressed cache of code_diff results.
+
+    Entries are keyed by the SHA-256 of the code before and after a change
+    and a namespace (e.g. the code_diff version). Hence, an update of code_diff
+    invalidates all entries. Results are saved as JSON in a sqlite database
+    in WAL mode, which can be shared by several worker processes.
+    """
+
+    MISSING = object()
+
+    def __init__(self, db_path, namespace = ""):
+        self.db_path = db_path
+        self.namespace = namespace
+
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        # Connections must not be shared with forked processes
+        if self._connection is not None and self._pid == os.getpid(): return self._connection
+
+        connection = sqlite3.connect(self.db_path, timeout = 60, isolation_level = None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)")
+
+        self._connection, self._pid = connection, os.getpid()
+        return connection
+
+    def key(self, before, after):
+        digest = hashlib.sha256()
+        for part in (self.namespace, before, after):
+            digest.update(part.encode("utf-8", "surrogatepass"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def get(self, before, after):
+        """Returns the cached result or DiffCache.MISSING."""
+        row = self._connect().execute("SELECT value FROM results WHERE key = ?",
+                                        (self.key(before, after),)).fetchone()
+        return json.loads(row[0]) if row is not None else DiffCache.MISSING
+
+    def put(self, before, after, result):
+        self._connect().execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                                    (self.key(before, after), json.dumps(result)))
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
@@ -0,0 +1,106 @@
+import json
+
+from .edit_abstraction import abstract_edit_script
+
+# Compact edit scripts ----------------------------------------------------------------
+# Edit scripts of code_diff are saved as JSON strings (e.g. [["Update", ["identifier:x", 1, 0, 1, 1], "y"]]).
+# The compact encoding is a JSON object saved directly in the entry:
+#   {"types": ["identifier:x"], "ops": [[0, [0, 1, 0, 1, 1], "y"]]}
+# Operations are replaced by operation codes and node labels by indices into the type table.
+# Labels that occur several times in an edit script are saved once.
+
+OPERATIONS = ["Update", "Insert", "Move", "Delete"]
+OPCODES    = {operation: opcode for opcode, operation in enumerate(OPERATIONS)}
+
+
+def _encode_node(types, node):
+    if isinstance(node, str): return node # Reference to an inserted node (e.g. N0)
+
+    label = node[0]
+    if label not in types: types[label] = len(types)
+    return [types[label]] + node[1:]
+
+
+def _decode_node(types, node):
+    if isinstance(node, str): return node
+    return [types[node[0]]] + node[1:]
+
+
+def encode_edit_script(edit_script):
+    types = {}
+    ops = []
+
+    for operation in edit_script:
+        name, target, *args = operation
+        encoded = [OPCODES[name], _encode_node(types, target)]
+
+        if name in ("Insert", "Move"):
+            encoded.extend([_encode_node(types, args[0]), args[1]])
+        else:
+            encoded.extend(args) # Update value
+
+        ops.append(encoded)
+
+    return {"types": list(types), "ops": ops}
+
+
+def decode_edit_script(compact_edit_script):
+    types = compact_edit_script["types"]
+    edit_script = []
+
+    for operation in compact_edit_script["ops"]:
+        opcode, target, *args = operation
+        name = OPERATIONS[opcode]
+        decoded = [name, _decode_node(types, target)]
+
+        if name in ("Insert", "Move"):
+            decoded.extend([_decode_node(types, args[0]), args[1]])
+        else:
+            decoded.extend(args)
+
+        edit_script.append(decoded)
+
+    return edit_script
+
+
+# Derived fields ----------------------------------------------------------------
+
+def edit_pattern_of(edit_script):
+    return ["%s_%s" % operation for operation in abstract_edit_script(edit_script)]
+
+
+def derived_edit_fields(edit_script, edit_script_json = None):
+    """Fields that later stages would otherwise compute from the edit script."""
+
+    if edit_script_json is None: edit_script_json = json.dumps(edit_script)
+
+    return {
+        "edit_count"  : len(edit_script),
+        "parse_error" : "ERROR" in edit_script_json, # Same check as rm_parse_errors always did
+        "edit_pattern": edit_pattern_of(edit_script),
+    }
+
+
+# Reader ----------------------------------------------------------------
+# Entries might contain a plain edit_script (JSON string) or a compact_edit_script
+# with derived fields. Derived fields are used if present and computed otherwise.
+
+def read_edit_script(slc):
+    if "compact_edit_script" in slc: return decode_edit_script(slc["compact_edit_script"])
+    return json.loads(slc["edit_script"])
+
+
+def edit_count(slc):
+    if "edit_count" in slc: return slc["edit_count"]
+    return len(read_edit_script(slc))
+
+
+def has_parse_error(slc):
+    if "parse_error" in slc: return slc["parse_error"]
+    if "edit_script" in slc: return "ERROR" in slc["edit_script"]
+    return "ERROR" in json.dumps(read_edit_script(slc))
+
+
+def edit_pattern(slc):
+    if "edit_pattern" in slc: return slc["edit_pattern"]
+    return edit_pattern_of(read_edit_script(slc))
@@ -0,0 +1,197 @@
+import subprocess
+
+from pathlib import Path
+
+from git.diff import Diff, decode_path
+from pydriller import ModificationType
+from pydriller.domain.commit import ModifiedFile
+
+# Streaming git log engine ----------------------------------------------------------------
+# Parses a single `git log --patch` stream into lightweight commits.
+# Commits and modified files mimic the attributes of PyDriller objects
+# (diffs are split with the same header regex and git diff options as GitPython).
+# Source code is only loaded on demand, e.g. for changed_methods.
+
+COMMIT_MARKER = b"\x00\x00"
+
+GIT_LOG_OPTIONS = ["--patch", "-M", "--full-index", "--abbrev=40", "--no-ext-diff", "--no-color",
+                    "--format=%x00%x00%H %P%n%B%x00"]
+
+
+class BlobReader:
+    """Reads blobs from a long running `git cat-file --batch` process."""
+
+    def __init__(self, repo_path):
+        self.process = subprocess.Popen(["git", "cat-file", "--batch"], cwd = repo_path,
+                                        stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+
+    def read(self, blob_id):
+        self.process.stdin.write(blob_id.encode("ascii") + b"\n")
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline().split()
+        if len(header) != 3: return None # Missing object
+
+        data = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1) # Trailing newline
+        return data
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class LogModifiedFile(ModifiedFile):
+    """A PyDriller ModifiedFile that loads its source code lazily."""
+
+    def __init__(self, old_path, new_path, change_type, diff, blob_ids, blob_reader):
+        self._blob_ids = blob_ids
+        self._blob_reader = blob_reader
+        self._sources = {}
+
+        super().__init__(old_path, new_path, change_type,
+                            {"diff": diff, "source_code": None, "source_code_before": None})
+
+    def _load_source(self, index):
+        if index not in self._sources:
+            blob_id = self._blob_ids[index]
+            data = self._blob_reader.read(blob_id) if blob_id is not None else None
+            self._sources[index] = data.decode("utf-8", "ignore") if data is not None else None
+        return self._sources[index]
+
+    @property
+    def source_code_before(self):
+        return self._load_source(0)
+
+    @source_code_before.setter
+    def source_code_before(self, value):
+        pass # Set by ModifiedFile.__init__
+
+    @property
+    def source_code(self):
+        return self._load_source(1)
+
+    @source_code.setter
+    def source_code(self, value):
+        pass
+
+
+class LogCommit:
+
+    def __init__(self, project_name, commit_hash, parents, msg, modified_files):
+        self.project_name = project_name
+        self.hash = commit_hash
+        self.parents = parents
+        self.msg = msg
+        self.modified_files = modified_files
+
+    @property
+    def merge(self):
+        return len(self.parents) > 1
+
+
+# Parsing ----------------------------------------------------------------
+
+def _blob_id(blob_id):
+    if blob_id is None: return None
+    blob_id = blob_id.decode("ascii")
+    return None if blob_id == Diff.NULL_HEX_SHA else blob_id
+
+
+def _change_type(header, a_blob_id, b_blob_id):
+    # Same as PyDriller for GitPython diffs
+    groups = header.groupdict()
+
+    if groups["new_file_mode"]: return ModificationType.ADD
+    if groups["deleted_file_mode"]: return ModificationType.DELETE
+
+    rename_from = groups["rename_from"].decode("utf-8", "replace") if groups["rename_from"] else None
+    rename_to   = groups["rename_to"].decode("utf-8", "replace") if groups["rename_to"] else None
+    if rename_from != rename_to: return ModificationType.RENAME
+
+    if a_blob_id and b_blob_id and a_blob_id != b_blob_id: return ModificationType.MODIFY
+    return ModificationType.UNKNOWN
+
+
+def _pick_path(path, rename_path, fallback_path):
+    if path: path = decode_path(path)
+    elif rename_path: path = decode_path(rename_path, has_ab_prefix = False)
+    elif fallback_path: path = decode_path(fallback_path)
+    else: return None
+
+    return path.decode("utf-8", "replace") if path is not None else None
+
+
+def parse_patch(patch, blob_reader):
+    modified_files = []
+    headers = list(Diff.re_header.finditer(patch))
+
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(patch)
+        diff = patch[header.end(): end]
+
+        a_blob_id, b_blob_id = _blob_id(header.group("a_blob_id")), _blob_id(header.group("b_blob_id"))
+        old_path = _pick_path(header.group("a_path"), header.group("rename_from"), header.group("a_path_fallback"))
+        new_path = _pick_path(header.group("b_path"), header.group("rename_to"), header.group("b_path_fallback"))
+
+        modified_files.append(LogModifiedFile(
+            old_path, new_path, _change_type(header, a_blob_id, b_blob_id),
+            diff.decode("utf-8", "ignore"), (a_blob_id, b_blob_id), blob_reader
+        ))
+
+    return modified_files
+
+
+def parse_log_record(record, project_name, blob_reader):
+    header, _, record = record.partition(b"\n")
+    msg, _, patch = record.partition(b"\x00\n")
+    if patch.startswith(b"\n"): patch = patch[1:]
+
+    commit_hash, *parents = header[len(COMMIT_MARKER):].decode("ascii").split()
+    msg = msg.decode("utf-8", "replace").strip()
+
+    return LogCommit(project_name, commit_hash, parents, msg, parse_patch(patch, blob_reader))
+
+
+# API method ----------------------------------------------------------------
+
+def iter_log_commits(repo_path, from_commit = None, commits = None, to_commit = None):
+    """
+    Streams all commits of the repository from oldest to newest (same order as PyDriller).
+
+    If from_commit is given, only commits after from_commit are visited.
+    If to_commit is given, only commits up to to_commit are visited (default: HEAD).
+    If commits is given, only the given commits are visited in the given order.
+    """
+
+    to_commit = to_commit if to_commit is not None else "HEAD"
+
+    command = ["git", "-c", "diff.mnemonicPrefix=false", "log"] + GIT_LOG_OPTIONS
+    if commits is not None:
+        command += ["--no-walk=unsorted", "--stdin"]
+    else:
+        command += ["--reverse", "%s..%s" % (from_commit, to_commit) if from_commit is not None else to_commit]
+
+    project_name = Path(repo_path).name
+    blob_reader  = BlobReader(repo_path)
+
+    process = subprocess.Popen(command, cwd = repo_path, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+    try:
+        if commits is not None: process.stdin.write("".join(c + "\n" for c in commits).encode("ascii"))
+        process.stdin.close()
+
+        record = []
+        for line in process.stdout:
+            if line.startswith(COMMIT_MARKER) and len(record) > 0:
+                yield parse_log_record(b"".join(record), project_name, blob_reader)
+                record = []
+            record.append(line)
+
+        if len(record) > 0:
+            yield parse_log_record(b"".join(record), project_name, blob_reader)
+
+    finally:
+        process.stdout.close()
+        if process.poll() is None: process.kill()
+        process.wait()
+        blob_reader.close()
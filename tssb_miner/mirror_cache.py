@@ -0,0 +1,142 @@
+import os
+import re
+import shutil
+import fcntl
+import hashlib
+import subprocess
+
+from contextlib import contextmanager
+
+
+# Helpers ----------------------------------------------------------------
+
+def normalize_url(repo_url):
+    """Normalizes a repository url such that all variants of the same url share a mirror."""
+
+    url = repo_url.strip()
+    url = re.sub(r"^[a-zA-Z+]+://", "", url)   # Scheme
+    url = re.sub(r"^[^/@]*@", "", url)          # Credentials (e.g. https://:@github.com)
+    url = url.replace(":", "/", 1) if re.match(r"^[^/]+:[^/]", url) else url # scp-like git@host:user/repo
+
+    url = url.rstrip("/")
+    if url.endswith(".git"): url = url[:-len(".git")]
+
+    host, _, path = url.partition("/")
+    return "%s/%s" % (host.lower(), path) if path else host.lower()
+
+
+def repo_name(repo_url):
+    # Same as the project name PyDriller derives from a url
+    url = repo_url.rstrip("/")
+    name = url[url.rfind("/") + 1:]
+    return name[:-len(".git")] if name.endswith(".git") else name
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def run_git(*args, cwd = None):
+    env = dict(os.environ, GIT_TERMINAL_PROMPT = "0")
+    subprocess.run(["git"] + list(args), cwd = cwd, env = env, check = True,
+                    stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+
+
+# Mirror cache ----------------------------------------------------------------
+
+class MirrorCache:
+    """
+    Shared cache of bare mirror clones.
+
+    Mirrors are keyed by the normalized repository url and refreshed with
+    a fetch instead of a fresh clone. If the cache exceeds max_bytes, the least
+    recently used mirrors are removed. Mirrors in use are locked and never removed.
+
+    A mirror is saved as <cache_dir>/<key hash>/<repo name> such that
+    PyDriller reports the same project name as for the original url.
+    """
+
+    def __init__(self, cache_dir, max_bytes = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _entry_dir(self, repo_url):
+        key = normalize_url(repo_url)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+    def mirror_path(self, repo_url):
+        return os.path.join(self._entry_dir(repo_url), repo_name(repo_url))
+
+    def _update(self, repo_url, mirror_path):
+        if os.path.isdir(mirror_path):
+            run_git("fetch", "--prune", "origin", cwd = mirror_path)
+            return
+
+        tmp_path = mirror_path + ".tmp"
+        if os.path.exists(tmp_path): shutil.rmtree(tmp_path)
+        os.makedirs(os.path.dirname(mirror_path), exist_ok = True)
+
+        run_git("clone", "--mirror", "--quiet", repo_url, tmp_path)
+        os.rename(tmp_path, mirror_path)
+
+    @contextmanager
+    def open(self, repo_url, update = True):
+        """Yields the path to an up-to-date mirror of the repository."""
+
+        entry_dir = self._entry_dir(repo_url)
+        mirror_path = os.path.join(entry_dir, repo_name(repo_url))
+
+        with open(entry_dir + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if update or not os.path.isdir(mirror_path):
+                    self._update(repo_url, mirror_path)
+                os.utime(entry_dir + ".lock") # Last used
+
+                fcntl.flock(lock, fcntl.LOCK_SH) # Others may read but not evict
+                self.evict()
+
+                yield mirror_path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entries(self):
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".lock"): continue
+            entry_dir = os.path.join(self.cache_dir, file_name[:-len(".lock")])
+            if os.path.isdir(entry_dir): yield entry_dir
+
+    def evict(self):
+        if self.max_bytes is None: return []
+
+        entries = [(os.path.getmtime(entry_dir + ".lock"), dir_size(entry_dir), entry_dir)
+                    for entry_dir in self._entries()]
+        total_size = sum(size for _, size, _ in entries)
+
+        evicted = []
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes: break
+
+            with open(entry_dir + ".lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue # In use
+
+                try:
+                    shutil.rmtree(entry_dir) # Lock files are kept as other processes might wait for them
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+            total_size -= size
+            evicted.append(entry_dir)
+
+        return evicted
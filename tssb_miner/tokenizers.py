@@ -1,5 +1,6 @@
+import re
 import token
-import tokenize
+from tokenize import generate_tokens
 
 from io import StringIO
 
@@ -12,6 +13,10 @@ def tokenize(text, lang = "python"):
         for tok in pytokenize_text(text): yield tok
         return
 
+    if lang in C_LIKE_OPERATORS:
+        for tok in ctokenize_text(text, lang): yield tok
+        return
+
     raise ValueError("Unknown language: %s" % lang)
 
 
@@ -29,6 +34,10 @@ def iter_stmts(text, lang = "python"):
         for stmt in pyiter_stmts(text): yield stmt
         return
 
+    if lang in C_LIKE_OPERATORS:
+        for stmt in citer_stmts(text): yield stmt
+        return
+
     raise ValueError("Unknown language: %s" % lang)
 
 
@@ -37,7 +46,7 @@ def iter_stmts(text, lang = "python"):
 def pytokenize_text(line):
 
     try:
-        for tok in tokenize.generate_tokens(StringIO(line).readline):
+        for tok in generate_tokens(StringIO(line).readline):
             yield (tok.string, token.tok_name[tok.type])
     except Exception:
         yield ("ERROR", "ERROR")
@@ -61,4 +70,89 @@ def pyiter_stmts(text):
         
         if should_split:
             if i != start_ix: yield text[start_ix:i]
-            start_ix = i + 1
\ No newline at end of file
+            start_ix = i + 1
+
+
+# Java / JavaScript tokenizer ----------------------------------------------------------------
+# Lightweight regex tokenizer for C-like languages.
+# Token types follow the names of the Python tokenizer (NAME, NUMBER, STRING, OP, COMMENT).
+
+C_LIKE_OPERATORS = {
+    "java": [">>>=", "<<=", ">>=", ">>>", "...", "->", "::", "++", "--", "&&", "||",
+                "==", "!=", "<=", ">=", "+=", "-=", "*=", "/=", "%=", "&=", "|=", "^=", "<<", ">>"],
+    "javascript": [">>>=", "===", "!==", "**=", "<<=", ">>=", ">>>", "...", "&&=", "||=", "??=",
+                    "=>", "++", "--", "&&", "||", "??", "?.", "**", "==", "!=", "<=", ">=", 
+                    "+=", "-=", "*=", "/=", "%=", "&=", "|=", "^=", "<<", ">>"]
+}
+
+
+def _c_token_pattern(operators):
+    return re.compile("|".join([
+        r"(?P<COMMENT>//.*|/\*[\s\S]*?(?:\*/|$))",
+        r"(?P<STRING>\"(?:\\.|[^\"\\])*\"?|'(?:\\.|[^'\\])*'?|`(?:\\.|[^`\\])*`?)",
+        r"(?P<NUMBER>(?:0[xX][0-9a-fA-F_]+|0[bB][01_]+|(?:\d[\d_]*\.?[\d_]*|\.\d[\d_]*)(?:[eE][+-]?\d+)?)[a-zA-Z]*)",
+        r"(?P<NAME>[A-Za-z_$][\w$]*)",
+        r"(?P<OP>%s|[^\w\s])" % "|".join(re.escape(op) for op in operators),
+        r"(?P<WS>\s+)",
+    ]))
+
+
+C_LIKE_PATTERNS = {lang: _c_token_pattern(operators) for lang, operators in C_LIKE_OPERATORS.items()}
+
+
+def ctokenize_text(line, lang = "java"):
+
+    for match in C_LIKE_PATTERNS[lang].finditer(line):
+        if match.lastgroup == "WS": continue
+        yield (match.group(), match.lastgroup)
+
+
+def _skip_literal(text, i):
+    # Returns the end of the string or comment starting at i (or i if there is none).
+    # Strings end at a line break if they are not closed (except template strings).
+    c = text[i]
+
+    if text.startswith("//", i):
+        end = text.find("\n", i)
+        return len(text) if end < 0 else end
+
+    if text.startswith("/*", i):
+        end = text.find("*/", i + 2)
+        return len(text) if end < 0 else end + 2
+
+    if c in "\"'`":
+        j = i + 1
+        while j < len(text) and text[j] != c:
+            if text[j] == "\\": j += 1
+            elif text[j] == "\n" and c != "`": return j
+            j += 1
+        return min(j + 1, len(text))
+
+    return i
+
+
+def citer_stmts(text):
+    # Statements end with a semicolon or a line break outside of parentheses or with a block bracket.
+    # Strings and comments are never split (block comments might span several lines).
+
+    start_ix = 0
+    depth = 0
+    i = 0
+
+    while i < len(text):
+        end = _skip_literal(text, i)
+        if end > i: i = end; continue
+
+        c = text[i]
+        i += 1
+
+        if c in "([": depth += 1; continue
+        if c in ")]": depth = max(depth - 1, 0); continue
+
+        should_split = c in "{}" or (c in ";\n" and depth == 0)
+
+        if should_split:
+            if len(text[start_ix:i - 1].strip()) > 0: yield text[start_ix:i - 1]
+            start_ix = i
+
+    if len(text[start_ix:].strip()) > 0: yield text[start_ix:]
@@ -0,0 +1,214 @@
+import os
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+
+
+# Work queue ----------------------------------------------------------------
+
+class Lease:
+    """
+    A claimed item. The lease file is named <key>.<token> with a token unique to the claim.
+
+    If the lease expires and the item is claimed again, the lease file of the new claim 
+    has another name. Therefore, a worker can only touch, complete or release its own lease.
+    """
+
+    def __init__(self, queue, key, item, lease_path, attempts = 0):
+        self.queue = queue
+        self.key = key
+        self.item = item
+        self.lease_path = lease_path
+        self.attempts = attempts # Failed attempts of earlier claims
+
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target = self._beat, daemon = True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.queue.heartbeat_interval):
+            try:
+                os.utime(self.lease_path)
+            except FileNotFoundError:
+                print("Lost lease of %s (expired and re-queued)" % self.item)
+                return
+
+    def _finish(self, target_path):
+        self._stop.set()
+        self._heartbeat.join()
+
+        try:
+            os.rename(self.lease_path, target_path)
+            return True
+        except FileNotFoundError:
+            return False # Lease expired. The item is crawled again by another worker.
+
+    def complete(self, status = "completed"):
+        done_path = os.path.join(self.queue.done_dir, self.key)
+        if not self._finish(done_path): return False
+
+        with open(done_path, "a") as o:
+            o.write("%s\n" % status)
+        return True
+
+    def release(self):
+        # Gives the item back to the queue without waiting for the lease to expire
+        return self._finish(os.path.join(self.queue.pending_dir, self.key))
+
+    def fail(self, max_attempts = 3):
+        """Gives a failed item back to the queue. After max_attempts failures, the item is completed as failed."""
+        if self.attempts + 1 >= max_attempts: return self.complete("failed")
+
+        try:
+            with open(self.lease_path, "a") as o:
+                o.write("failed %s\n" % time.strftime("%Y-%m-%dT%H:%M:%S"))
+        except FileNotFoundError:
+            pass # Lease expired. Releasing fails as well.
+
+        return self.release()
+
+
+class WorkQueue:
+    """
+    Queue of work items on a (shared) file system.
+
+    Every item is a file that moves from pending/ to leases/ to done/.
+    Items are claimed by an atomic rename. A claimed item is leased
+    and the lease file is touched regularly by a heartbeat thread.
+    Leases without a heartbeat for lease_timeout seconds are moved back to pending/.
+
+    Items are processed at least once: a worker that loses its lease
+    does not stop and might process an item a second time.
+    Failed items are queued again (see Lease.fail). Every failure is appended to the item file.
+    """
+
+    def __init__(self, queue_dir, lease_timeout = 600, heartbeat_interval = 30):
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+
+        self.pending_dir = os.path.join(queue_dir, "pending")
+        self.lease_dir   = os.path.join(queue_dir, "leases")
+        self.done_dir    = os.path.join(queue_dir, "done")
+
+    def initialize(self, items, wait_interval = 1.0):
+        """
+        Fills the queue with the given items. Only the first process fills the queue, all others wait for it.
+
+        Items can be given as a function. It is only called if the queue does not exist yet and 
+        before the initialization lock is taken, such that the lock is only held while items are written.
+        A lock without progress for lease_timeout seconds (e.g. of a crashed process) is removed.
+        """
+
+        os.makedirs(self.queue_dir, exist_ok = True)
+        init_dir = os.path.join(self.queue_dir, "pending.init")
+
+        if os.path.isdir(self.pending_dir): return False
+
+        if callable(items): items = items()
+
+        while True:
+            try:
+                os.mkdir(init_dir) # Atomic, even on network file systems
+                break
+            except FileExistsError:
+                if self._wait_for_initialization(init_dir, wait_interval): return False
+
+        if os.path.isdir(self.pending_dir):
+            # Another process finished the initialization in the meantime
+            os.rmdir(init_dir)
+            return False
+
+        try:
+            for i, item in enumerate(items):
+                key = "%08d-%s" % (i, hashlib.sha1(item.encode("utf-8")).hexdigest()[:8])
+                with open(os.path.join(init_dir, key), "w") as o:
+                    o.write(item + "\n")
+
+            os.makedirs(self.lease_dir, exist_ok = True)
+            os.makedirs(self.done_dir, exist_ok = True)
+            os.rename(init_dir, self.pending_dir)
+        except FileNotFoundError:
+            # Another process considered the lock as stale and removed it
+            return self.initialize(items, wait_interval)
+
+        return True
+
+    def _wait_for_initialization(self, init_dir, wait_interval):
+        # Returns True if the queue was filled by another process and False if the lock is gone.
+        # Every written item updates the modification time of the lock directory.
+        while not os.path.isdir(self.pending_dir):
+            try:
+                idle_time = time.time() - os.path.getmtime(init_dir)
+            except FileNotFoundError:
+                return os.path.isdir(self.pending_dir) # Renamed to pending/ or removed
+
+            if idle_time > self.lease_timeout:
+                print("Remove stale lock %s (no progress for %d seconds)" % (init_dir, idle_time))
+                stale_dir = "%s.stale-%s" % (init_dir, uuid.uuid4().hex[:12])
+                try:
+                    os.rename(init_dir, stale_dir) # Only one process removes the lock
+                    shutil.rmtree(stale_dir, ignore_errors = True)
+                except FileNotFoundError:
+                    pass
+                return False
+
+            time.sleep(wait_interval)
+
+        return True
+
+    def _read_item(self, path):
+        # First line: item, following lines: failed attempts
+        with open(path, "r") as i:
+            lines = i.read().splitlines()
+        return lines[0], sum(1 for line in lines[1:] if line.startswith("failed"))
+
+    def claim(self):
+        """Leases the next pending item. Returns None if no item is pending."""
+
+        for key in sorted(os.listdir(self.pending_dir)):
+            pending_path = os.path.join(self.pending_dir, key)
+            lease_path   = os.path.join(self.lease_dir, "%s.%s" % (key, uuid.uuid4().hex[:12]))
+
+            try:
+                os.utime(pending_path) # A fresh lease should not look expired
+                os.rename(pending_path, lease_path)
+            except FileNotFoundError:
+                continue # Claimed by another worker
+
+            item, attempts = self._read_item(lease_path)
+            return Lease(self, key, item, lease_path, attempts)
+
+        return None
+
+    def requeue_expired(self):
+        """Moves all expired leases back to pending."""
+
+        requeued = []
+        now = time.time()
+
+        for file_name in os.listdir(self.lease_dir):
+            lease_path = os.path.join(self.lease_dir, file_name)
+            key = file_name.rsplit(".", 1)[0] # Without the token of the claim
+            try:
+                if now - os.path.getmtime(lease_path) < self.lease_timeout: continue
+                os.rename(lease_path, os.path.join(self.pending_dir, key))
+            except FileNotFoundError:
+                continue # Completed or re-queued by another worker
+
+            requeued.append(key)
+
+        return requeued
+
+    def counts(self):
+        return {
+            "pending": len(os.listdir(self.pending_dir)),
+            "leased" : len(os.listdir(self.lease_dir)),
+            "done"   : len(os.listdir(self.done_dir))
+        }
+
+    def is_finished(self):
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["leased"] == 0
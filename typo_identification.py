@@ -6,9 +6,8 @@ Computes the precentage of bugs that reflect a typo (Damerau Levenshtein distanc
 
 from mapreduce import mapreduce
 from fastDamerauLevenshtein import damerauLevenshtein
-import json
-
 from code_diff.diff_utils import parse_hunks
+from tssb_miner.edit_encoding import edit_count, read_edit_script
 
 def get_match_line(hunk):
     assert len(hunk.added_lines) == 1
@@ -43,8 +42,8 @@ def text_dist(slc):
 
 
 def update_dist(slc):
-    edit_script = json.loads(slc["edit_script"])
-    if len(edit_script) != 1: return []
+    if edit_count(slc) != 1: return []
+    edit_script = read_edit_script(slc)
     if edit_script[0][0] != "Update": return []
     if "string" not in edit_script[0][1][0]: return []
 